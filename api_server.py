@@ -0,0 +1,498 @@
+"""
+Local HTTP generation API for Bulk Jewelry Image Generator
+An asyncio (aiohttp) service so other systems (e.g. a PIM) can push batch jobs:
+
+    POST   /jobs                      submit a batch job (JSON), returns its id
+    GET    /jobs/{id}                 job status
+    GET    /jobs/{id}/events          progress and results as server-sent events
+    GET    /jobs/{id}/results         finished results as JSON
+    GET    /jobs/{id}/images/{index}  a finished image from the local store
+    GET    /jobs/{id}/zip             all finished images as a ZIP
+    DELETE /jobs/{id}                 cancel a job, keeping what already finished
+
+Run with:  FAL_KEY=... python api_server.py --port 8765
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import threading
+import time
+import zipfile
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+import budget
+import config
+from budget import CancelToken, JobBudget
+from generator import (download_image, generate_images_parallel, iter_results,
+                       iter_variation_prompts, stream_results_to_disk)
+from performance import performance_model
+
+
+class ApiJob:
+    """State of one submitted job, shared by its generation thread and the event loop"""
+
+    def __init__(self, job_id: str, request: Dict, job_dir: str, cancel_token: CancelToken):
+        self.id = job_id
+        self.request = request
+        self.dir = job_dir
+        self.manifest = os.path.join(job_dir, 'results.jsonl')
+        self.status = 'queued'
+        self.total = request['num_images']
+        self.succeeded = 0
+        self.failed = 0
+        self.stop_reason: Optional[str] = None
+        self.spent = 0.0
+        self.created = time.time()
+        self.cancel_token = cancel_token
+        self.images: Dict[int, str] = {}  # variation index -> local file
+        self.subscribers: Set[asyncio.Queue] = set()
+        self._lock = threading.Lock()
+        self.zip_lock = threading.Lock()  # one ZIP build at a time per job
+        self.zip_state: Optional[Tuple[int, bool]] = None  # (images, finished) the ZIP was built from
+
+    def add_image(self, index: int, filepath: str):
+        with self._lock:
+            self.images[index] = filepath
+            self.succeeded += 1
+
+    def add_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def image_files(self) -> Dict[int, str]:
+        """Snapshot of the finished images, safe to iterate while the job runs"""
+        with self._lock:
+            return dict(self.images)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'cancelled', 'failed')
+
+    def snapshot(self) -> Dict:
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'spent': round(self.spent, 4),
+            'stop_reason': self.stop_reason,
+            'created': self.created
+        }
+
+    def results(self) -> List[Dict]:
+        """Finished results from the manifest; blocking, so run it off the event loop"""
+        images = self.image_files()
+        return [{
+            'index': result['metadata']['index'],
+            'url': result['url'],
+            'image_url': f"/jobs/{self.id}/images/{result['metadata']['index']}",
+            'metadata': result['metadata']
+        } for result in iter_results(self.manifest) if result['metadata']['index'] in images]
+
+    def publish(self, event: str, data: Dict):
+        """Fan an event out to every SSE subscriber (event loop thread only)"""
+        for queue in self.subscribers:
+            queue.put_nowait((event, data))
+
+
+# Variation lists a job may override (see generator.iter_variation_prompts)
+VARIATION_KEYS = ('materials', 'gemstones', 'styles', 'angles', 'backgrounds', 'lighting')
+OUTPUT_FORMATS = ('png', 'jpeg')
+
+
+def _parse_variations(variations) -> Dict:
+    if not isinstance(variations, dict):
+        raise ValueError("variations must be an object")
+    for name, values in variations.items():
+        if name not in VARIATION_KEYS:
+            raise ValueError(f"unknown variation: {name} (expected one of {', '.join(VARIATION_KEYS)})")
+        if (not isinstance(values, list) or not values
+                or not all(isinstance(value, str) and value for value in values)):
+            raise ValueError(f"variations.{name} must be a non-empty list of strings")
+    return variations
+
+
+def _parse_job_request(body: Dict) -> Dict:
+    """Validate a job submission, filling defaults; raises ValueError"""
+    if not isinstance(body, dict):
+        raise ValueError("request body must be a JSON object")
+    base_prompt = body.get('base_prompt')
+    if body.get('template'):
+        template = config.TEMPLATES.get(body['template'])
+        if template is None:
+            raise ValueError(f"unknown template: {body['template']}")
+        base_prompt = template['prompt']
+    if not base_prompt or not isinstance(base_prompt, str):
+        raise ValueError("base_prompt or template is required")
+
+    num_images = int(body.get('num_images', config.DEFAULT_SETTINGS['num_images']))
+    if not 1 <= num_images <= config.API_CONFIG['max_images_per_job']:
+        raise ValueError(f"num_images must be between 1 and {config.API_CONFIG['max_images_per_job']}")
+
+    model_params = {
+        'model': config.DEFAULT_MODEL,
+        'image_size': '1024x1024',
+        'num_inference_steps': 28,
+        'guidance_scale': 3.5,
+        'output_format': 'png',
+        'enable_safety_checker': True
+    }
+    if not isinstance(body.get('model_params') or {}, dict):
+        raise ValueError("model_params must be an object")
+    model_params.update(body.get('model_params') or {})
+    if model_params['model'] not in config.FLUX_MODELS:
+        raise ValueError(f"unknown model: {model_params['model']}")
+    try:
+        width, height = (int(v) for v in str(model_params['image_size']).lower().split('x'))
+    except ValueError:
+        width = height = 0
+    if width <= 0 or height <= 0:
+        raise ValueError(f"image_size must be WIDTHxHEIGHT, e.g. 1024x768, not {model_params['image_size']!r}")
+    model_params['image_size'] = f"{width}x{height}"
+    steps = int(model_params['num_inference_steps'])
+    if not 1 <= steps <= config.API_CONFIG['max_inference_steps']:
+        raise ValueError(f"num_inference_steps must be between 1 and {config.API_CONFIG['max_inference_steps']}")
+    model_params['num_inference_steps'] = steps
+    model_params['guidance_scale'] = float(model_params['guidance_scale'])
+    # Becomes part of the stored image's file name
+    if model_params['output_format'] not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {', '.join(OUTPUT_FORMATS)}")
+
+    max_cost = body.get('max_cost')
+    deadline_seconds = body.get('deadline_seconds')
+
+    max_workers = int(body.get('max_workers', config.DEFAULT_SETTINGS['max_workers']))
+    max_workers = max(1, min(max_workers, config.RATE_LIMIT_CONFIG['max_concurrent_requests']))
+
+    return {
+        'base_prompt': base_prompt,
+        'num_images': num_images,
+        'variations': _parse_variations(body.get('variations') or {}),
+        'model_params': model_params,
+        'max_workers': max_workers,
+        'max_cost': float(max_cost) if max_cost is not None else None,
+        'deadline_seconds': float(deadline_seconds) if deadline_seconds is not None else None,
+        'fal_key': body.get('fal_key') or os.environ.get('FAL_KEY')
+    }
+
+
+class GenerationService:
+    """Runs submitted jobs on background threads and tracks them for the HTTP handlers"""
+
+    def __init__(self, data_dir: str, max_concurrent_jobs: int):
+        self.data_dir = data_dir
+        self.jobs: Dict[str, ApiJob] = {}
+        self._slots = threading.Semaphore(max_concurrent_jobs)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def submit(self, request: Dict) -> ApiJob:
+        # Registered like UI jobs, so budget.cancel_job works for API jobs too
+        cancel_token = CancelToken()
+        job_id = budget.register_job(cancel_token)
+        job = ApiJob(job_id, request, os.path.join(self.data_dir, job_id), cancel_token)
+        os.makedirs(job.dir, exist_ok=True)
+        self.jobs[job_id] = job
+        threading.Thread(target=self._run, args=(job,), name=f"job-{job_id}", daemon=True).start()
+        return job
+
+    def _emit(self, job: ApiJob, event: str, data: Dict):
+        """Publish from a generation thread onto the event loop"""
+        self._loop.call_soon_threadsafe(job.publish, event, data)
+
+    def _set_status(self, job: ApiJob, status: str):
+        job.status = status
+        self._emit(job, 'status', job.snapshot())
+
+    def _run(self, job: ApiJob):
+        request = job.request
+        with self._slots:
+            if job.cancel_token.is_set():
+                job.stop_reason = job.cancel_token.reason
+                self._set_status(job, 'cancelled')
+                budget.unregister_job(job.id)
+                self._emit(job, 'end', job.snapshot())
+                return
+            self._set_status(job, 'running')
+
+            downloads = None
+            try:
+                model_params = request['model_params']
+                job_budget = JobBudget(
+                    cost_per_image=performance_model.cost_per_image(model_params['model'], model_params['image_size']),
+                    max_cost=request['max_cost'],
+                    deadline_seconds=request['deadline_seconds'],
+                    user_id=budget.user_key(request['fal_key']),
+                    ledger=budget.user_ledger
+                )
+                prompts = iter_variation_prompts(request['base_prompt'], request['num_images'], request['variations'])
+                results = stream_results_to_disk(
+                    generate_images_parallel(prompts, request['fal_key'], model_params, request['max_workers'],
+                                             budget=job_budget, cancel_token=job.cancel_token,
+                                             perf=performance_model),
+                    job.manifest
+                )
+
+                # Images are fetched into the local store on their own pool, off the results path
+                downloads = concurrent.futures.ThreadPoolExecutor(max_workers=request['max_workers'])
+                for result in results:
+                    if result['success']:
+                        downloads.submit(self._store_image, job, result)
+                    else:
+                        job.add_failure()
+                        self._emit(job, 'error', {'index': result['metadata']['index'],
+                                                  'error': result['error']})
+                downloads.shutdown(wait=True)
+                job.spent = job_budget.spent
+                job.stop_reason = job.cancel_token.reason or job_budget.stop_reason
+                self._set_status(job, 'cancelled' if job.cancel_token.is_set() else 'done')
+            except Exception as e:
+                if downloads is not None:
+                    downloads.shutdown(wait=False, cancel_futures=True)
+                job.stop_reason = f"job failed: {e}"
+                self._set_status(job, 'failed')
+            finally:
+                budget.unregister_job(job.id)
+                self._emit(job, 'end', job.snapshot())
+
+    def _store_image(self, job: ApiJob, result: Dict):
+        index = result['metadata']['index']
+        fmt = job.request['model_params']['output_format']
+        filepath = os.path.join(job.dir, f"jewelry_{index:05d}.{fmt}")
+        try:
+            download_image(result['url'], filepath)
+        except Exception as e:
+            job.add_failure()
+            self._emit(job, 'error', {'index': index, 'error': f"download failed: {e}"})
+            return
+        job.add_image(index, filepath)
+        self._emit(job, 'result', {
+            'index': index,
+            'url': result['url'],
+            'image_url': f"/jobs/{job.id}/images/{index}",
+            'metadata': result['metadata']
+        })
+
+    def prune(self) -> List[str]:
+        """Forget finished jobs past the retention limits; returns their directories"""
+        api_config = config.API_CONFIG
+        cutoff = time.time() - api_config['job_retention_seconds']
+        finished = sorted((job for job in self.jobs.values() if job.finished), key=lambda job: job.created)
+        excess = len(finished) - api_config['max_retained_jobs']
+        expired = [job for i, job in enumerate(finished) if i < excess or job.created < cutoff]
+        for job in expired:
+            del self.jobs[job.id]
+        return [job.dir for job in expired]
+
+    def remove_job_dirs(self, job_dirs: List[str]):
+        """Delete the local store of pruned jobs (blocking)"""
+        for job_dir in job_dirs:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def sweep_stale_dirs(self):
+        """Delete job directories left by earlier runs once past the retention age (blocking)"""
+        if not os.path.isdir(self.data_dir):
+            return
+        cutoff = time.time() - config.API_CONFIG['job_retention_seconds']
+        self.remove_job_dirs([entry.path for entry in os.scandir(self.data_dir)
+                              if entry.is_dir() and entry.name not in self.jobs
+                              and entry.stat().st_mtime < cutoff])
+
+    def build_zip(self, job: ApiJob) -> str:
+        """ZIP of the finished images, rebuilt whenever images were added since the last build"""
+        zip_path = os.path.join(job.dir, 'images.zip')
+        with job.zip_lock:
+            # Read the finish state first: once finished, the image snapshot is complete
+            finished = job.finished
+            images = job.image_files()
+            state = (len(images), finished)
+            if job.zip_state == state and os.path.exists(zip_path):
+                return zip_path
+            tmp_path = zip_path + '.tmp'
+            with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=config.EXPORT_CONFIG['zip_compression']) as zipf:
+                for index, filepath in sorted(images.items()):
+                    zipf.write(filepath, os.path.basename(filepath))
+                if config.EXPORT_CONFIG['include_metadata_json'] and os.path.exists(job.manifest):
+                    zipf.write(job.manifest, 'results.jsonl')
+            os.replace(tmp_path, zip_path)
+            job.zip_state = state
+        return zip_path
+
+
+# HTTP handlers
+
+routes = web.RouteTableDef()
+
+
+def _get_job(request: web.Request) -> ApiJob:
+    job = request.app['service'].jobs.get(request.match_info['job_id'])
+    if job is None:
+        raise web.HTTPNotFound(text=json.dumps({'error': 'job not found'}), content_type='application/json')
+    return job
+
+
+@routes.get('/health')
+async def health(request: web.Request) -> web.Response:
+    jobs = request.app['service'].jobs.values()
+    return web.json_response({'ok': True, 'running': sum(1 for job in jobs if job.status == 'running')})
+
+
+@routes.post('/jobs')
+async def submit_job(request: web.Request) -> web.Response:
+    try:
+        job_request = _parse_job_request(await request.json())
+        # Estimated before the job starts, so a bad request never leaves a job running
+        estimate = performance_model.estimate(
+            job_request['model_params']['model'], job_request['model_params']['image_size'],
+            job_request['model_params']['num_inference_steps'], job_request['num_images'],
+            job_request['max_workers']
+        )
+    except (ValueError, TypeError) as e:
+        return web.json_response({'error': str(e)}, status=400)
+    if not job_request['fal_key']:
+        return web.json_response({'error': 'fal_key is required (or set FAL_KEY for the server)'}, status=400)
+
+    service = request.app['service']
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(None, service.remove_job_dirs, service.prune())
+    job = service.submit(job_request)
+    return web.json_response({
+        'job_id': job.id,
+        'status_url': f"/jobs/{job.id}",
+        'events_url': f"/jobs/{job.id}/events",
+        'estimated_cost': round(estimate['cost'], 4),
+        'estimated_seconds': round(estimate['eta_seconds'], 1)
+    }, status=202)
+
+
+@routes.get('/jobs/{job_id}')
+async def job_status(request: web.Request) -> web.Response:
+    return web.json_response(_get_job(request).snapshot())
+
+
+@routes.delete('/jobs/{job_id}')
+async def cancel_job(request: web.Request) -> web.Response:
+    job = _get_job(request)
+    if not job.finished:
+        # Cancelling calls fal for every in-flight request, so keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, job.cancel_token.cancel, "cancelled via API")
+    return web.json_response(job.snapshot(), status=202)
+
+
+@routes.get('/jobs/{job_id}/results')
+async def job_results(request: web.Request) -> web.Response:
+    job = _get_job(request)
+    results = await asyncio.get_running_loop().run_in_executor(None, job.results)
+    return web.json_response({'job_id': job.id, 'status': job.status, 'results': results})
+
+
+@routes.get('/jobs/{job_id}/events')
+async def job_events(request: web.Request) -> web.StreamResponse:
+    job = _get_job(request)
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    await response.prepare(request)
+
+    async def send(event: str, data: Dict):
+        await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+
+    # Subscribe before replaying so nothing published in between is lost
+    queue: asyncio.Queue = asyncio.Queue()
+    job.subscribers.add(queue)
+    try:
+        await send('status', job.snapshot())
+        # Replayed from the manifest, so replayed and live results have the same payload
+        replayed = set()
+        for result in await asyncio.get_running_loop().run_in_executor(None, job.results):
+            replayed.add(result['index'])
+            await send('result', result)
+        if job.finished:
+            await send('end', job.snapshot())
+            return response
+
+        keepalive = config.API_CONFIG['sse_keepalive_seconds']
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                await response.write(b": keepalive\n\n")
+                continue
+            if event == 'result' and data['index'] in replayed:
+                continue
+            await send(event, data)
+            if event == 'end':
+                break
+    except ConnectionResetError:
+        pass
+    finally:
+        job.subscribers.discard(queue)
+    return response
+
+
+@routes.get('/jobs/{job_id}/images/{index}')
+async def job_image(request: web.Request) -> web.StreamResponse:
+    job = _get_job(request)
+    try:
+        filepath = job.image_files()[int(request.match_info['index'])]
+    except (KeyError, ValueError):
+        raise web.HTTPNotFound(text=json.dumps({'error': 'image not found'}), content_type='application/json')
+    return web.FileResponse(filepath)
+
+
+@routes.get('/jobs/{job_id}/zip')
+async def job_zip(request: web.Request) -> web.StreamResponse:
+    job = _get_job(request)
+    if not job.images:
+        return web.json_response({'error': 'no finished images yet'}, status=404)
+    zip_path = await asyncio.get_running_loop().run_in_executor(None, request.app['service'].build_zip, job)
+    return web.FileResponse(zip_path, headers={
+        'Content-Disposition': f'attachment; filename="jewelry_{job.id}.zip"'
+    })
+
+
+def create_app(data_dir: Optional[str] = None) -> web.Application:
+    api_config = config.API_CONFIG
+    app = web.Application(client_max_size=api_config['max_request_bytes'])
+    app['service'] = GenerationService(data_dir or api_config['data_dir'], api_config['max_concurrent_jobs'])
+
+    async def on_startup(app: web.Application):
+        loop = asyncio.get_running_loop()
+        app['service'].start(loop)
+        loop.run_in_executor(None, app['service'].sweep_stale_dirs)
+
+    async def on_shutdown(app: web.Application):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, job.cancel_token.cancel, "server shutting down")
+                               for job in list(app['service'].jobs.values()) if not job.finished))
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.add_routes(routes)
+    return app
+
+
+def main(argv: Optional[list] = None):
+    api_config = config.API_CONFIG
+    parser = argparse.ArgumentParser(description="Jewelry image generation HTTP API")
+    parser.add_argument("--host", default=api_config['host'])
+    parser.add_argument("--port", type=int, default=api_config['port'])
+    parser.add_argument("--data-dir", default=api_config['data_dir'], help="Local store for job results")
+    args = parser.parse_args(argv)
+    web.run_app(create_app(args.data_dir), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
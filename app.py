@@ -1,15 +1,25 @@
 import streamlit as st
-import fal_client
-import os
 import requests
-from PIL import Image
-from io import BytesIO
-import base64
+import os
 import time
-import concurrent.futures
-from typing import List, Dict
+import uuid
+from PIL import Image
+from typing import Iterable
 import zipfile
 
+import budget
+import config
+from budget import CancelToken, JobBudget
+from generator import (append_results, generate_images_parallel, iter_results,
+                       iter_variation_prompts, stream_results_to_disk)
+from performance import performance_model
+from profiling import RerunProfiler
+from results import ImageStore, ResultRecord, ResultTable, sweep_image_stores
+from work_queue import WorkQueue
+
+# Times each section of this rerun for the debug panel
+profiler = RerunProfiler()
+
 # Page configuration
 st.set_page_config(
     page_title="Bulk Jewelry Image Generator - Flux 2",
@@ -19,160 +29,238 @@ st.set_page_config(
 )
 
 # Custom CSS for better UI
-st.markdown("""
-    <style>
-    .main-header {
-        font-size: 2.5rem;
-        font-weight: bold;
-        color: #1E40AF;
-        text-align: center;
-        margin-bottom: 1rem;
-    }
-    .sub-header {
-        font-size: 1.2rem;
-        color: #64748B;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    .stImage {
-        border-radius: 10px;
-        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-    }
-    .success-box {
-        padding: 1rem;
-        background-color: #D1FAE5;
-        border-radius: 8px;
-        border-left: 4px solid #10B981;
-        margin: 1rem 0;
-    }
-    .info-box {
-        padding: 1rem;
-        background-color: #DBEAFE;
-        border-radius: 8px;
-        border-left: 4px solid #3B82F6;
-        margin: 1rem 0;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+with profiler.section("Page setup & CSS"):
+    st.markdown("""
+        <style>
+        .main-header {
+            font-size: 2.5rem;
+            font-weight: bold;
+            color: #1E40AF;
+            text-align: center;
+            margin-bottom: 1rem;
+        }
+        .sub-header {
+            font-size: 1.2rem;
+            color: #64748B;
+            text-align: center;
+            margin-bottom: 2rem;
+        }
+        .stImage {
+            border-radius: 10px;
+            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
+        }
+        .success-box {
+            padding: 1rem;
+            background-color: #D1FAE5;
+            border-radius: 8px;
+            border-left: 4px solid #10B981;
+            margin: 1rem 0;
+        }
+        .info-box {
+            padding: 1rem;
+            background-color: #DBEAFE;
+            border-radius: 8px;
+            border-left: 4px solid #3B82F6;
+            margin: 1rem 0;
+        }
+        </style>
+        """, unsafe_allow_html=True)
 
 # Initialize session state
 if 'generated_images' not in st.session_state:
-    st.session_state.generated_images = []
+    st.session_state.generated_images = ResultTable()
+if 'image_store' not in st.session_state:
+    # Stores of sessions that ended without being garbage collected (e.g. a crash)
+    sweep_image_stores(config.RESULT_STORE_CONFIG['sessions_dir'],
+                       config.RESULT_STORE_CONFIG['session_max_age_seconds'])
+    st.session_state.image_store = ImageStore(
+        os.path.join(config.RESULT_STORE_CONFIG['sessions_dir'], f"{uuid.uuid4().hex}.bin")
+    )
+if 'download_row' not in st.session_state:
+    st.session_state.download_row = None
 if 'generation_complete' not in st.session_state:
     st.session_state.generation_complete = False
+if 'active_job_id' not in st.session_state:
+    st.session_state.active_job_id = None
+if 'stop_reason' not in st.session_state:
+    st.session_state.stop_reason = None
+if 'queue_job_id' not in st.session_state:
+    st.session_state.queue_job_id = None
+if 'queue_last_task_id' not in st.session_state:
+    st.session_state.queue_last_task_id = 0
+if 'queue_reservation' not in st.session_state:
+    st.session_state.queue_reservation = None
+if 'session_user_id' not in st.session_state:
+    # Budget key for queue jobs submitted without an API token
+    st.session_state.session_user_id = uuid.uuid4().hex[:16]
+if 'results_manifest' not in st.session_state:
+    st.session_state.results_manifest = None
+if 'total_generated' not in st.session_state:
+    st.session_state.total_generated = 0
+if 'rerun_history' not in st.session_state:
+    st.session_state.rerun_history = []
+
+@st.cache_resource
+def get_work_queue() -> WorkQueue:
+    """Shared handle on the worker queue database"""
+    return WorkQueue(config.QUEUE_CONFIG['db_path'])
+
+@st.cache_resource
+def load_catalogs(config_mtime: float) -> dict:
+    """One shared, read-only copy of the config catalogs for every session
+
+    Keyed on config.py's modification time so edits invalidate it.
+    """
+    return {
+        'templates': {name: template['prompt'] for name, template in config.TEMPLATES.items()},
+        'materials': list(config.MATERIALS),
+        'gemstones': list(config.GEMSTONES),
+        'styles': list(config.STYLES),
+        'angles': list(config.ANGLES),
+        'backgrounds': list(config.BACKGROUNDS),
+        'lighting': list(config.LIGHTING),
+        'models': list(config.FLUX_MODELS)
+    }
+
+@st.cache_data(max_entries=32)
+def manifest_statistics(manifest_path: str, total: int) -> dict:
+    """Category counts for a streamed job; ``total`` invalidates it as results arrive"""
+    counts = {'material': {}, 'gemstone': {}, 'style': {}}
+    for result in iter_results(manifest_path):
+        for name, category_counts in counts.items():
+            value = result['metadata'][name]
+            category_counts[value] = category_counts.get(value, 0) + 1
+    return counts
+
+with profiler.section("Load catalogs"):
+    catalogs = load_catalogs(os.path.getmtime(config.__file__))
+
+def stop_generation():
+    """Cancel the running job; whatever already finished is kept"""
+    job_id = st.session_state.active_job_id
+    if job_id is not None:
+        budget.cancel_job(job_id)
+        st.session_state.stop_reason = "cancelled by user"
+    st.session_state.active_job_id = None
+    if st.session_state.queue_job_id is not None:
+        get_work_queue().cancel_job(st.session_state.queue_job_id)
+        st.session_state.stop_reason = "cancelled by user"
+    st.session_state.generation_complete = bool(st.session_state.generated_images)
+
+def keep_result(result: dict):
+    """Count a successful result; keep only a preview in session when streaming to disk"""
+    st.session_state.total_generated += 1
+    if (st.session_state.results_manifest is None
+            or len(st.session_state.generated_images) < config.STREAM_CONFIG['session_preview_limit']):
+        st.session_state.generated_images.append(result)
 
-def get_image_base64(image_path_or_url):
-    """Convert image to base64 for API"""
-    if image_path_or_url.startswith('http'):
-        response = requests.get(image_path_or_url)
-        img = Image.open(BytesIO(response.content))
+def all_results():
+    """Every successful result of the last job, read lazily from disk when streamed"""
+    if st.session_state.results_manifest is not None:
+        return (ResultRecord.from_result(result) for result in iter_results(st.session_state.results_manifest))
+    return iter(st.session_state.generated_images)
+
+def get_image_bytes(record: ResultRecord) -> bytes:
+    """Image bytes from the session's on-disk store, fetching them on first use"""
+    store = st.session_state.image_store
+    if record.image_ref is not None:
+        return store.get(record.image_ref)
+    if record.path and os.path.exists(record.path):
+        with open(record.path, 'rb') as f:
+            data = f.read()
     else:
-        img = Image.open(image_path_or_url)
-    
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+        data = requests.get(record.url).content
+    image_ref = store.put(data)
+    if record.row >= 0:
+        st.session_state.generated_images.set_image(record.row, image_ref)
+    return data
 
-def create_variations_prompts(base_prompt: str, num_variations: int, params: Dict) -> List[Dict]:
-    """Create varied prompts for jewelry generation"""
-    
-    materials = params.get('materials', ['gold', 'silver', 'platinum', 'rose gold'])
-    gemstones = params.get('gemstones', ['diamond', 'sapphire', 'emerald', 'ruby'])
-    styles = params.get('styles', ['modern', 'vintage', 'minimalist', 'ornate'])
-    angles = params.get('angles', ['front view', 'side view', '3/4 view', 'top view'])
-    backgrounds = params.get('backgrounds', ['white studio background', 'luxury velvet background', 
-                                             'marble surface', 'minimalist gray background'])
-    lighting = params.get('lighting', ['studio lighting', 'natural daylight', 'dramatic lighting', 
-                                       'soft diffused light'])
-    
-    prompts = []
-    
-    for i in range(num_variations):
-        material = materials[i % len(materials)]
-        gemstone = gemstones[i % len(gemstones)]
-        style = styles[i % len(styles)]
-        angle = angles[i % len(angles)]
-        background = backgrounds[i % len(backgrounds)]
-        light = lighting[i % len(lighting)]
-        
-        variation_prompt = f"{base_prompt}, {material} jewelry, {gemstone} stones, {style} style, {angle}, {background}, {light}, professional product photography, high detail, 8K resolution, commercial photography"
-        
-        prompts.append({
-            'prompt': variation_prompt,
-            'metadata': {
-                'material': material,
-                'gemstone': gemstone,
-                'style': style,
-                'angle': angle,
-                'background': background,
-                'lighting': light,
-                'index': i + 1
-            }
-        })
-    
-    return prompts
+def affordable_images(amount: float, image_cost: float) -> int:
+    """Whole images a spend amount covers, tolerating float rounding"""
+    return int(amount / image_cost + 1e-9)
 
-def generate_single_image(prompt_data: Dict, api_token: str, model_params: Dict) -> Dict:
-    """Generate a single image using fal.ai Flux"""
-    try:
-        os.environ["FAL_KEY"] = api_token
-        
-        # Choose model based on params
-        model_choice = model_params.get('model', 'fal-ai/flux/dev')
-        
-        # fal.ai Flux model
-        result = fal_client.subscribe(
-            model_choice,
-            arguments={
-                "prompt": prompt_data['prompt'],
-                "image_size": model_params.get('image_size', '1024x1024'),
-                "num_inference_steps": model_params.get('num_inference_steps', 28),
-                "guidance_scale": model_params.get('guidance_scale', 3.5),
-                "num_images": 1,
-                "enable_safety_checker": model_params.get('enable_safety_checker', True),
-                "output_format": model_params.get('output_format', 'png')
-            }
-        )
-        
-        # Get image URL from result
-        if isinstance(result, dict) and 'images' in result:
-            image_url = result['images'][0]['url']
-        else:
-            image_url = result
-        
-        return {
-            'success': True,
-            'url': image_url,
-            'metadata': prompt_data['metadata']
-        }
-    except Exception as e:
-        return {
-            'success': False,
-            'error': str(e),
-            'metadata': prompt_data['metadata']
-        }
+def reserve_queue_job(user_id: str, image_cost: float, num_images: int, max_job_cost: float) -> int:
+    """Reserve a queue job's spend against the user's daily limit; returns the images covered
+
+    Workers run outside this process, so the whole job is reserved up front
+    and settled by settle_queue_job once it finishes.
+    """
+    if st.session_state.queue_job_id is not None:
+        # The job being watched is replaced, so stop it and settle what it finished
+        work_queue = get_work_queue()
+        work_queue.cancel_job(st.session_state.queue_job_id)
+        progress = work_queue.job_progress(st.session_state.queue_job_id)
+        settle_queue_job(progress['counts']['done'] if progress is not None else 0)
+    if max_job_cost:
+        num_images = min(num_images, affordable_images(max_job_cost, image_cost))
+    spend_remaining = budget.user_ledger.spend_remaining(user_id)
+    if spend_remaining is not None:
+        num_images = min(num_images, affordable_images(spend_remaining, image_cost))
+    if num_images <= 0 or not budget.user_ledger.reserve(user_id, num_images * image_cost):
+        return 0
+    st.session_state.queue_reservation = {
+        'user_id': user_id,
+        'image_cost': image_cost,
+        'images': num_images,
+        'submitted': time.time()
+    }
+    return num_images
+
+def settle_queue_job(done: int):
+    """Charge a finished queue job's images and release the rest of its reservation"""
+    reservation = st.session_state.queue_reservation
+    if reservation is None:
+        return
+    st.session_state.queue_reservation = None
+    user_id, image_cost = reservation['user_id'], reservation['image_cost']
+    done = min(done, reservation['images'])
+    budget.user_ledger.settle(user_id, done * image_cost, charged=True)
+    budget.user_ledger.settle(user_id, (reservation['images'] - done) * image_cost, charged=False)
+    budget.user_ledger.add_time(user_id, time.time() - reservation['submitted'])
+
+def prepare_download(row: int):
+    """Fetch one image into the store; only its download button carries bytes"""
+    get_image_bytes(st.session_state.generated_images[row])
+    st.session_state.download_row = row
 
-def generate_images_parallel(prompts: List[Dict], api_token: str, model_params: Dict, max_workers: int = 5):
-    """Generate multiple images in parallel"""
-    results = []
+def watch_queue_job(job_id: str):
+    """Poll a worker queue job, collecting results until it finishes"""
+    work_queue = get_work_queue()
+    progress_bar = st.progress(0)
+    status_text = st.empty()
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(generate_single_image, prompt, api_token, model_params): prompt 
-                   for prompt in prompts}
+    while True:
+        new_results = work_queue.job_results(job_id, st.session_state.queue_last_task_id)
+        if new_results:
+            if st.session_state.results_manifest is not None:
+                append_results(st.session_state.results_manifest, new_results)
+            for result in new_results:
+                keep_result(result)
+            st.session_state.queue_last_task_id = new_results[-1]['task_id']
+            st.session_state.generation_complete = True
         
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            results.append(result)
-            yield result
-
-def download_image(url: str, filepath: str):
-    """Download image from URL"""
-    response = requests.get(url)
-    with open(filepath, 'wb') as f:
-        f.write(response.content)
+        progress = work_queue.job_progress(job_id)
+        if progress is None:
+            break
+        counts = progress['counts']
+        finished = counts['done'] + counts['failed'] + counts['cancelled']
+        progress_bar.progress(finished / max(progress['total'], 1))
+        workers = len(work_queue.active_workers())
+        status_text.text(f"Generated {counts['done']} images ({counts['failed']} errors, "
+                         f"{counts['leased']} in progress, {counts['queued']} queued) - {workers} workers online")
+        if progress['finished']:
+            break
+        time.sleep(config.QUEUE_CONFIG['poll_interval'])
+    
+    st.session_state.queue_job_id = None
+    st.session_state.generation_complete = True
+    settle_queue_job(progress['counts']['done'] if progress is not None else 0)
+    if progress is not None and progress['status'] == 'cancelled':
+        st.session_state.stop_reason = "cancelled by user"
+    elif progress is not None and progress['status'] == 'expired':
+        st.session_state.stop_reason = "deadline reached"
 
-def create_zip_file(image_urls: List[str], zip_path: str):
+def create_zip_file(image_urls: Iterable[str], zip_path: str):
     """Create a zip file with all generated images"""
     with zipfile.ZipFile(zip_path, 'w') as zipf:
         for idx, url in enumerate(image_urls):
@@ -188,7 +276,7 @@ st.markdown('<div class="main-header">💎 Bulk Jewelry Image Generator</div>',
 st.markdown('<div class="sub-header">Generate 50+ high-quality jewelry variations using Flux 2 AI</div>', unsafe_allow_html=True)
 
 # Sidebar Configuration
-with st.sidebar:
+with st.sidebar, profiler.section("Sidebar"):
     st.header("⚙️ Configuration")
     
     # API Token - Check Streamlit secrets first, then allow manual input
@@ -224,13 +312,8 @@ with st.sidebar:
     
     model_choice = st.selectbox(
         "Flux Model",
-        options=[
-            "fal-ai/flux/dev",
-            "fal-ai/flux-pro/v1.1", 
-            "fal-ai/flux-2-pro",
-            "fal-ai/flux/schnell"
-        ],
-        index=0,
+        options=catalogs['models'],
+        index=catalogs['models'].index(config.DEFAULT_MODEL),
         help="Dev: Best balance. Pro: Highest quality. Schnell: Fastest"
     )
     
@@ -268,43 +351,99 @@ with st.sidebar:
     if use_custom_variations:
         materials = st.multiselect(
             "Materials",
-            options=['gold', 'silver', 'platinum', 'rose gold', 'white gold', 'titanium'],
-            default=['gold', 'silver', 'platinum', 'rose gold']
+            options=catalogs['materials'],
+            default=catalogs['materials'][:4]
         )
         
         gemstones = st.multiselect(
             "Gemstones",
-            options=['diamond', 'sapphire', 'emerald', 'ruby', 'pearl', 'amethyst', 'topaz'],
-            default=['diamond', 'sapphire', 'emerald', 'ruby']
+            options=catalogs['gemstones'],
+            default=catalogs['gemstones'][:4]
         )
         
         styles = st.multiselect(
             "Styles",
-            options=['modern', 'vintage', 'minimalist', 'ornate', 'art deco', 'bohemian'],
-            default=['modern', 'vintage', 'minimalist', 'ornate']
+            options=catalogs['styles'],
+            default=catalogs['styles'][:4]
         )
     else:
-        materials = ['gold', 'silver', 'platinum', 'rose gold']
-        gemstones = ['diamond', 'sapphire', 'emerald', 'ruby']
-        styles = ['modern', 'vintage', 'minimalist', 'ornate']
+        materials = catalogs['materials'][:4]
+        gemstones = catalogs['gemstones'][:4]
+        styles = catalogs['styles'][:4]
     
     st.markdown("---")
     
     # Generation settings
     st.subheader("⚡ Generation Settings")
     
+    run_mode = st.radio(
+        "Run Generation On",
+        options=["This app", "Worker queue"],
+        horizontal=True,
+        help="Worker queue: jobs are picked up by `python worker.py` processes that share the queue database"
+    )
+    
+    auto_tune = st.checkbox(
+        "Auto-tune Workers",
+        value=False,
+        help="Pick the fewest workers that meet the deadline, using timings from past requests"
+    )
+    
+    auto_model = st.checkbox(
+        "Auto-select Model",
+        value=False,
+        disabled=not auto_tune,
+        help="Also switch to the cheapest model that meets the deadline"
+    )
+    
     max_workers = st.slider(
         "Parallel Workers",
         min_value=1,
-        max_value=10,
-        value=5,
+        max_value=config.RATE_LIMIT_CONFIG['max_concurrent_requests'],
+        value=config.DEFAULT_SETTINGS['max_workers'],
+        disabled=auto_tune,
         help="Higher = faster but may hit rate limits"
     )
+    
+    stream_to_disk = st.checkbox(
+        "Stream Results to Disk",
+        value=False,
+        help=f"Write every result to {config.STREAM_CONFIG['results_dir']} and keep only "
+             f"the first {config.STREAM_CONFIG['session_preview_limit']} in the gallery. For very large jobs"
+    )
+    
+    st.markdown("---")
+    
+    # Budget settings
+    st.subheader("💸 Budget")
+    
+    max_job_cost = st.number_input(
+        "Max Spend per Job ($)",
+        min_value=0.0,
+        value=float(config.BUDGET_CONFIG['max_cost_per_job'] or 0.0),
+        step=0.5,
+        help="Stop submitting new images once this is reached. 0 = no limit"
+    )
+    
+    max_job_minutes = st.number_input(
+        "Deadline (minutes)",
+        min_value=0.0,
+        value=float((config.BUDGET_CONFIG['max_seconds_per_job'] or 0) / 60),
+        step=1.0,
+        help="Cancel queued requests and keep finished images after this long. 0 = no limit"
+    )
+    
+    # Queue jobs may be submitted without a token, so fall back to a per-session id
+    user_id = budget.user_key(api_token) if api_token else st.session_state.session_user_id
+    usage = budget.user_ledger.usage(user_id)
+    spend_limit = budget.user_ledger.daily_spend_limit
+    if spend_limit is not None:
+        st.caption(f"Today: ${usage['spent']:.2f} of ${spend_limit:.2f} daily limit used")
 
 # Main Content Area
 tab1, tab2, tab3 = st.tabs(["📝 Input", "🖼️ Gallery", "📊 Statistics"])
 
-with tab1:
+with tab1, profiler.section("Input tab"):
     st.header("Input Your Jewelry Design")
     
     col1, col2 = st.columns([1, 1])
@@ -335,28 +474,11 @@ with tab1:
         st.subheader("Quick Templates")
         template = st.selectbox(
             "Choose a template (optional)",
-            options=[
-                "Custom (use your description)",
-                "Engagement Ring - Classic Solitaire",
-                "Necklace - Pendant Chain",
-                "Bracelet - Tennis Style",
-                "Earrings - Stud Design",
-                "Wedding Band - Classic",
-                "Cocktail Ring - Statement Piece"
-            ]
+            options=["Custom (use your description)"] + list(catalogs['templates'])
         )
         
-        template_prompts = {
-            "Engagement Ring - Classic Solitaire": "elegant engagement ring with classic solitaire design, round brilliant cut center stone, delicate prong setting, smooth polished band",
-            "Necklace - Pendant Chain": "elegant pendant necklace with delicate chain, centered gemstone pendant, sophisticated clasp design",
-            "Bracelet - Tennis Style": "tennis bracelet with continuous line of gemstones, secure clasp, uniform stone setting",
-            "Earrings - Stud Design": "classic stud earrings with secure post backing, symmetrical gemstone setting",
-            "Wedding Band - Classic": "wedding band with classic design, smooth polished finish, comfortable fit",
-            "Cocktail Ring - Statement Piece": "bold cocktail ring with large center stone, ornate setting design, dramatic presence"
-        }
-        
         if template != "Custom (use your description)":
-            base_prompt = template_prompts[template]
+            base_prompt = catalogs['templates'][template]
             st.info(f"Using template: {template}")
         
         st.markdown("---")
@@ -364,46 +486,74 @@ with tab1:
         # Cost estimation
         st.subheader("💰 Cost Estimation")
         
-        # fal.ai pricing per model
-        cost_per_image = {
-            "fal-ai/flux/dev": 0.025,
-            "fal-ai/flux-pro/v1.1": 0.04,
-            "fal-ai/flux-2-pro": 0.03,
-            "fal-ai/flux/schnell": 0.01
-        }
+        # Fitted from recorded request timings, falling back to config priors
+        if auto_tune:
+            candidate_models = config.FLUX_MODELS if auto_model else [model_choice]
+            estimate = performance_model.plan(
+                num_images, image_size, num_inference_steps,
+                deadline_seconds=max_job_minutes * 60 or None,
+                models=candidate_models,
+                max_workers=config.RATE_LIMIT_CONFIG['max_concurrent_requests']
+            )
+            model_choice = estimate['model']
+            max_workers = estimate['workers']
+            st.caption(f"Auto-tuned: {model_choice} with {max_workers} workers")
+            if not estimate['feasible']:
+                st.warning("⚠️ No configuration meets the deadline; using the fastest one")
+        else:
+            estimate = performance_model.estimate(model_choice, image_size, num_inference_steps,
+                                                  num_images, max_workers)
         
-        estimated_cost = num_images * cost_per_image.get(model_choice, 0.025)
-        estimated_time = num_images / max_workers * (num_inference_steps / 4)  # rough estimate
+        image_cost = performance_model.cost_per_image(model_choice, image_size)
+        estimated_cost = estimate['cost']
         
         st.metric("Estimated Cost", f"${estimated_cost:.2f}")
-        st.metric("Estimated Time", f"{estimated_time:.1f} minutes")
+        st.metric("Estimated Time", f"{estimate['eta_seconds'] / 60:.1f} minutes")
+        if estimate['samples']:
+            st.caption(f"Based on {estimate['samples']} recorded requests for this model and size")
+        else:
+            st.caption("No recorded requests yet for this model and size; using default timings")
+        
+        if max_job_cost and estimated_cost > max_job_cost:
+            st.warning(f"⚠️ Spend limit allows about {affordable_images(max_job_cost, image_cost)} of {num_images} images")
     
     # Generate button
     st.markdown("---")
     
     if st.button("🚀 Generate Images", type="primary", use_container_width=True):
-        if not api_token:
+        if not api_token and run_mode == "This app":
             st.error("❌ Please enter your Replicate API token in the sidebar!")
         elif not base_prompt:
             st.error("❌ Please provide a jewelry description!")
         else:
             # Reset previous results
-            st.session_state.generated_images = []
+            st.session_state.generated_images = ResultTable()
+            st.session_state.image_store.clear()
+            st.session_state.download_row = None
             st.session_state.generation_complete = False
+            st.session_state.total_generated = 0
+            st.session_state.results_manifest = (
+                os.path.join(config.STREAM_CONFIG['results_dir'], f"{uuid.uuid4().hex[:12]}.jsonl")
+                if stream_to_disk else None
+            )
             
             # Create variation prompts
             variation_params = {
                 'materials': materials,
                 'gemstones': gemstones,
                 'styles': styles,
-                'angles': ['front view', 'side view', '3/4 view', 'top view'],
-                'backgrounds': ['white studio background', 'luxury velvet background', 
-                               'marble surface', 'minimalist gray background'],
-                'lighting': ['studio lighting', 'natural daylight', 'dramatic lighting', 
-                            'soft diffused light']
+                'angles': catalogs['angles'][:4],
+                'backgrounds': catalogs['backgrounds'][:4],
+                'lighting': catalogs['lighting'][:4]
             }
             
-            prompts = create_variations_prompts(base_prompt, num_images, variation_params)
+            # Queue jobs are capped by the job and daily spend limits up front
+            num_prompts = num_images
+            if run_mode == "Worker queue":
+                num_prompts = reserve_queue_job(user_id, image_cost, num_images, max_job_cost)
+            
+            # Expanded lazily, so only the submission window is ever in memory
+            prompts = iter_variation_prompts(base_prompt, num_prompts, variation_params)
             
             # Model parameters
             model_params = {
@@ -415,37 +565,97 @@ with tab1:
                 'enable_safety_checker': True
             }
             
-            # Progress tracking
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            success_count = 0
-            error_count = 0
-            
-            # Generate images
-            for idx, result in enumerate(generate_images_parallel(prompts, api_token, model_params, max_workers)):
-                if result['success']:
-                    st.session_state.generated_images.append(result)
-                    success_count += 1
-                else:
-                    error_count += 1
-                
-                # Update progress
-                progress = (idx + 1) / num_images
-                progress_bar.progress(progress)
-                status_text.text(f"Generated {success_count} images ({error_count} errors) - {progress*100:.1f}% complete")
-            
-            st.session_state.generation_complete = True
-            
-            # Final status
-            if success_count > 0:
-                st.success(f"✅ Successfully generated {success_count} images!")
-                if error_count > 0:
-                    st.warning(f"⚠️ {error_count} images failed to generate")
+            if run_mode == "Worker queue" and not num_prompts:
+                st.error("❌ The spend limit does not cover any images")
+            elif run_mode == "Worker queue":
+                # Workers drop the job once the deadline or the user's daily time runs out
+                deadline_seconds = max_job_minutes * 60 or None
+                user_seconds = budget.user_ledger.seconds_remaining(user_id)
+                if user_seconds is not None:
+                    deadline_seconds = min(deadline_seconds or user_seconds, user_seconds)
+                st.session_state.queue_job_id = get_work_queue().submit_job(
+                    prompts, model_params, deadline_seconds=deadline_seconds)
+                st.session_state.queue_last_task_id = 0
+                st.session_state.stop_reason = None
+                st.info(f"📬 Submitted job {st.session_state.queue_job_id} with {num_prompts} images to the worker queue")
             else:
-                st.error("❌ Failed to generate any images. Please check your API token and try again.")
+                # Budget and cancellation for this job
+                job_budget = JobBudget(
+                    cost_per_image=image_cost,
+                    max_cost=max_job_cost or None,
+                    deadline_seconds=max_job_minutes * 60 or None,
+                    user_id=user_id,
+                    ledger=budget.user_ledger
+                )
+                cancel_token = CancelToken()
+                st.session_state.active_job_id = budget.register_job(cancel_token)
+                st.session_state.stop_reason = None
+                
+                st.button("⏹️ Stop Generation", on_click=stop_generation, use_container_width=True)
+                
+                # Progress tracking
+                progress_bar = st.progress(0)
+                status_text = st.empty()
+                
+                success_count = 0
+                error_count = 0
+                
+                # Generate images
+                finished = False
+                results = generate_images_parallel(prompts, api_token, model_params, max_workers,
+                                                   budget=job_budget, cancel_token=cancel_token,
+                                                   perf=performance_model)
+                if st.session_state.results_manifest is not None:
+                    results = stream_results_to_disk(results, st.session_state.results_manifest)
+                try:
+                    for idx, result in enumerate(results):
+                        if result['success']:
+                            keep_result(result)
+                            success_count += 1
+                        else:
+                            error_count += 1
+                        
+                        # Update progress
+                        progress = (idx + 1) / num_images
+                        progress_bar.progress(progress)
+                        status_text.text(f"Generated {success_count} images ({error_count} errors) - {progress*100:.1f}% complete")
+                    finished = True
+                finally:
+                    # A widget interaction (e.g. the stop button) interrupts this run
+                    if not finished:
+                        cancel_token.cancel("cancelled by user")
+                    # Runs the scheduler's cleanup now (settle reservations, stop the pool,
+                    # charge time) rather than whenever the generator is garbage-collected
+                    results.close()
+                    budget.unregister_job(st.session_state.active_job_id)
+                    st.session_state.active_job_id = None
+                
+                st.session_state.generation_complete = True
+                st.session_state.stop_reason = cancel_token.reason or job_budget.stop_reason
+                
+                # Final status
+                if st.session_state.stop_reason:
+                    st.warning(f"⏹️ Stopped early: {st.session_state.stop_reason} (${job_budget.spent:.2f} spent)")
+                if success_count > 0:
+                    st.success(f"✅ Successfully generated {success_count} images!")
+                    if error_count > 0:
+                        st.warning(f"⚠️ {error_count} images failed to generate")
+                else:
+                    st.error("❌ Failed to generate any images. Please check your API token and try again.")
+    
+    # Queue jobs outlive reruns: keep watching until the workers finish
+    if st.session_state.queue_job_id is not None:
+        st.button("⏹️ Stop Generation", key="stop_queue_job", on_click=stop_generation, use_container_width=True)
+        watch_queue_job(st.session_state.queue_job_id)
+        
+        if st.session_state.stop_reason:
+            st.warning(f"⏹️ Stopped early: {st.session_state.stop_reason}")
+        if st.session_state.generated_images:
+            st.success(f"✅ Successfully generated {st.session_state.total_generated} images!")
+        else:
+            st.error("❌ Failed to generate any images. Check that workers are running with a valid FAL_KEY.")
 
-with tab2:
+with tab2, profiler.section("Gallery tab"):
     st.header("Generated Images Gallery")
     
     if st.session_state.generation_complete and st.session_state.generated_images:
@@ -455,7 +665,7 @@ with tab2:
             if st.button("📥 Download All Images (ZIP)", type="primary", use_container_width=True):
                 with st.spinner("Creating zip file..."):
                     zip_path = "/home/claude/jewelry_images.zip"
-                    image_urls = [img['url'] for img in st.session_state.generated_images]
+                    image_urls = (img.url for img in all_results())
                     create_zip_file(image_urls, zip_path)
                     
                     with open(zip_path, 'rb') as f:
@@ -485,19 +695,25 @@ with tab2:
                                          default=[])
         
         # Display images in grid
-        filtered_images = st.session_state.generated_images
+        filtered_rows = st.session_state.generated_images.filter_rows(
+            material=filter_material,
+            gemstone=filter_gemstone,
+            style=filter_style
+        )
         
-        if filter_material:
-            filtered_images = [img for img in filtered_images 
-                             if img['metadata']['material'] in filter_material]
-        if filter_gemstone:
-            filtered_images = [img for img in filtered_images 
-                             if img['metadata']['gemstone'] in filter_gemstone]
-        if filter_style:
-            filtered_images = [img for img in filtered_images 
-                             if img['metadata']['style'] in filter_style]
+        st.info(f"Showing {len(filtered_rows)} of {st.session_state.total_generated} images")
+        if st.session_state.results_manifest is not None:
+            st.caption(f"Only the first {len(st.session_state.generated_images)} results are kept in the gallery; "
+                       f"all results are in {st.session_state.results_manifest}")
         
-        st.info(f"Showing {len(filtered_images)} of {len(st.session_state.generated_images)} images")
+        # Only the current page is rendered, so reruns stay cheap with large galleries
+        page_size = config.UI_CONFIG['gallery_page_size']
+        num_pages = max(1, -(-len(filtered_rows) // page_size))
+        page = 1
+        if num_pages > 1:
+            page = st.number_input(f"Page (of {num_pages})", min_value=1, max_value=num_pages, value=1)
+        filtered_images = [st.session_state.generated_images[row]
+                           for row in filtered_rows[(page - 1) * page_size:page * page_size]]
         
         # Grid layout
         cols_per_row = 4
@@ -507,47 +723,75 @@ with tab2:
                 if i + j < len(filtered_images):
                     img_data = filtered_images[i + j]
                     with col:
-                        st.image(img_data['url'], use_column_width=True)
+                        st.image(img_data.url, use_column_width=True)
                         with st.expander("Details"):
-                            st.write(f"**Index:** {img_data['metadata']['index']}")
-                            st.write(f"**Material:** {img_data['metadata']['material']}")
-                            st.write(f"**Gemstone:** {img_data['metadata']['gemstone']}")
-                            st.write(f"**Style:** {img_data['metadata']['style']}")
-                            st.write(f"**Angle:** {img_data['metadata']['angle']}")
+                            st.write(f"**Index:** {img_data.index}")
+                            st.write(f"**Material:** {img_data.material}")
+                            st.write(f"**Gemstone:** {img_data.gemstone}")
+                            st.write(f"**Style:** {img_data.style}")
+                            st.write(f"**Angle:** {img_data.angle}")
                             
-                            # Individual download
-                            response = requests.get(img_data['url'])
-                            st.download_button(
-                                label="Download",
-                                data=response.content,
-                                file_name=f"jewelry_{img_data['metadata']['index']:03d}.png",
-                                mime="image/png",
-                                use_container_width=True
-                            )
+                            # Bytes are read from the image store only for the image the user
+                            # asked to download, not for every visible image on every rerun
+                            if st.session_state.download_row == img_data.row:
+                                st.download_button(
+                                    label="Download",
+                                    data=get_image_bytes(img_data),
+                                    file_name=f"jewelry_{img_data.index:03d}.png",
+                                    mime="image/png",
+                                    use_container_width=True
+                                )
+                            else:
+                                st.button(
+                                    "Prepare Download",
+                                    key=f"prepare_download_{img_data.row}",
+                                    on_click=prepare_download,
+                                    args=(img_data.row,),
+                                    use_container_width=True
+                                )
     else:
         st.info("👆 Generate images from the Input tab to see them here!")
 
-with tab3:
+with tab3, profiler.section("Statistics tab"):
     st.header("Generation Statistics")
     
     if st.session_state.generation_complete and st.session_state.generated_images:
+        # Counted from the code columns, or from the manifest (cached per result count) when streamed
+        if st.session_state.results_manifest is not None:
+            category_counts = manifest_statistics(st.session_state.results_manifest,
+                                                  st.session_state.total_generated)
+        else:
+            category_counts = {name: st.session_state.generated_images.category_counts(name)
+                               for name in ('material', 'gemstone', 'style')}
+        material_counts = category_counts['material']
+        gemstone_counts = category_counts['gemstone']
+        styles_used = category_counts['style']
+        
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Total Generated", len(st.session_state.generated_images))
+            st.metric("Total Generated", st.session_state.total_generated)
         
         with col2:
-            materials_used = set(img['metadata']['material'] for img in st.session_state.generated_images)
-            st.metric("Materials Used", len(materials_used))
+            st.metric("Materials Used", len(material_counts))
         
         with col3:
-            gemstones_used = set(img['metadata']['gemstone'] for img in st.session_state.generated_images)
-            st.metric("Gemstones Used", len(gemstones_used))
+            st.metric("Gemstones Used", len(gemstone_counts))
         
         with col4:
-            styles_used = set(img['metadata']['style'] for img in st.session_state.generated_images)
             st.metric("Styles Used", len(styles_used))
         
+        # Per-session memory gauge
+        col1, col2 = st.columns(2)
+        heap_bytes = st.session_state.generated_images.nbytes()
+        if st.session_state.download_row is not None:
+            # The one prepared download is copied onto the heap on each rerun
+            heap_bytes += st.session_state.generated_images[st.session_state.download_row].image_ref[1]
+        with col1:
+            st.metric("Session Memory (heap)", f"{heap_bytes / 1024:.1f} KB")
+        with col2:
+            st.metric("Image Store (disk)", f"{st.session_state.image_store.size() / (1024 * 1024):.1f} MB")
+        
         st.markdown("---")
         
         # Breakdown by categories
@@ -555,21 +799,11 @@ with tab3:
         
         with col1:
             st.subheader("Breakdown by Material")
-            material_counts = {}
-            for img in st.session_state.generated_images:
-                mat = img['metadata']['material']
-                material_counts[mat] = material_counts.get(mat, 0) + 1
-            
             for material, count in sorted(material_counts.items(), key=lambda x: x[1], reverse=True):
                 st.write(f"**{material.title()}:** {count} images")
         
         with col2:
             st.subheader("Breakdown by Gemstone")
-            gemstone_counts = {}
-            for img in st.session_state.generated_images:
-                gem = img['metadata']['gemstone']
-                gemstone_counts[gem] = gemstone_counts.get(gem, 0) + 1
-            
             for gemstone, count in sorted(gemstone_counts.items(), key=lambda x: x[1], reverse=True):
                 st.write(f"**{gemstone.title()}:** {count} images")
     else:
@@ -583,3 +817,22 @@ st.markdown("""
         <p style='font-size: 0.9rem;'>Need help? Check the sidebar for configuration options</p>
     </div>
     """, unsafe_allow_html=True)
+
+# Rerun profile (debug panel)
+rerun_profile = profiler.summary()
+st.session_state.rerun_history = (st.session_state.rerun_history
+                                  + [rerun_profile['total_ms']])[-config.DEBUG_CONFIG['rerun_history']:]
+
+with st.sidebar:
+    st.markdown("---")
+    st.subheader("🐞 Debug")
+    
+    if st.checkbox("Show Rerun Profile", value=config.DEBUG_CONFIG['show_profiler']):
+        st.metric("Last Rerun", f"{rerun_profile['total_ms']:.1f} ms")
+        st.dataframe(rerun_profile['sections'], hide_index=True, use_container_width=True)
+        st.line_chart(st.session_state.rerun_history)
+        
+        if st.button("Clear Caches", use_container_width=True):
+            load_catalogs.clear()
+            manifest_statistics.clear()
+            st.rerun()
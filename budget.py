@@ -0,0 +1,236 @@
+"""
+Budgets and cancellation for Bulk Jewelry Image Generator
+Per-job and per-user limits on spend and wall-clock time, plus cancel tokens
+that let the UI (or any caller) stop a running generation job
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from datetime import date
+from typing import Dict, Optional
+
+import config
+
+
+def user_key(api_token: str) -> str:
+    """Derive a stable, non-secret user id from an API token"""
+    return hashlib.sha256(api_token.encode()).hexdigest()[:16]
+
+
+class CancelToken:
+    """Thread-safe cancellation flag that also cancels tracked fal requests"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._handles = set()
+        self.reason: Optional[str] = None
+
+    def is_set(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled by user"):
+        """Stop the job and cancel every fal request still being tracked"""
+        with self._lock:
+            if self.reason is None:
+                self.reason = reason
+            self._event.set()
+            handles = list(self._handles)
+        for handle in handles:
+            _cancel_handle(handle)
+
+    def track(self, handle):
+        """Remember an in-flight fal request so it can be cancelled later"""
+        with self._lock:
+            cancelled = self._event.is_set()
+            if not cancelled:
+                self._handles.add(handle)
+        if cancelled:
+            _cancel_handle(handle)
+
+    def untrack(self, handle):
+        with self._lock:
+            self._handles.discard(handle)
+
+
+def _cancel_handle(handle):
+    """Best-effort cancel of a queued fal request"""
+    try:
+        handle.cancel()
+    except Exception:
+        # Requests that already started or finished cannot be cancelled
+        pass
+
+
+class SpendLedger:
+    """Thread-safe per-user spend and generation time, reset daily"""
+
+    def __init__(self, daily_spend_limit: Optional[float] = None,
+                 daily_seconds_limit: Optional[float] = None):
+        self.daily_spend_limit = daily_spend_limit
+        self.daily_seconds_limit = daily_seconds_limit
+        self._lock = threading.Lock()
+        self._users: Dict[str, Dict] = {}
+
+    def _entry(self, user_id: str) -> Dict:
+        today = date.today().isoformat()
+        entry = self._users.get(user_id)
+        if entry is None or entry['day'] != today:
+            entry = {'day': today, 'spent': 0.0, 'reserved': 0.0, 'seconds': 0.0}
+            self._users[user_id] = entry
+        return entry
+
+    def usage(self, user_id: str) -> Dict:
+        """Snapshot of today's spend and generation time for a user"""
+        with self._lock:
+            return dict(self._entry(user_id))
+
+    def spend_remaining(self, user_id: str) -> Optional[float]:
+        if self.daily_spend_limit is None:
+            return None
+        with self._lock:
+            entry = self._entry(user_id)
+            return max(0.0, self.daily_spend_limit - entry['spent'] - entry['reserved'])
+
+    def seconds_remaining(self, user_id: str) -> Optional[float]:
+        if self.daily_seconds_limit is None:
+            return None
+        with self._lock:
+            return max(0.0, self.daily_seconds_limit - self._entry(user_id)['seconds'])
+
+    def reserve(self, user_id: str, amount: float) -> bool:
+        """Reserve spend for a request about to be submitted"""
+        with self._lock:
+            entry = self._entry(user_id)
+            if (self.daily_spend_limit is not None
+                    and entry['spent'] + entry['reserved'] + amount > self.daily_spend_limit + 1e-9):
+                return False
+            entry['reserved'] += amount
+            return True
+
+    def settle(self, user_id: str, amount: float, charged: bool):
+        """Release a reservation, charging it if the request was billed"""
+        with self._lock:
+            entry = self._entry(user_id)
+            entry['reserved'] = max(0.0, entry['reserved'] - amount)
+            if charged:
+                entry['spent'] += amount
+
+    def add_time(self, user_id: str, seconds: float) -> bool:
+        """Charge generation time; returns False once the daily limit is used up"""
+        with self._lock:
+            entry = self._entry(user_id)
+            entry['seconds'] += seconds
+            return self.daily_seconds_limit is None or entry['seconds'] < self.daily_seconds_limit
+
+
+class JobBudget:
+    """Spend and deadline limits for one generation job"""
+
+    def __init__(self, cost_per_image: float, max_cost: Optional[float] = None,
+                 deadline_seconds: Optional[float] = None, user_id: Optional[str] = None,
+                 ledger: Optional[SpendLedger] = None):
+        self.cost_per_image = cost_per_image
+        self.max_cost = max_cost
+        self.user_id = user_id
+        self.ledger = ledger
+        self.spent = 0.0
+        self.reserved = 0.0
+        self.stop_reason: Optional[str] = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.deadline_seconds = deadline_seconds
+        self.started = time.monotonic()
+        self._charged_at = self.started
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def reserve(self) -> bool:
+        """Reserve the cost of one more request, or record why it cannot run"""
+        with self._lock:
+            cost = self.cost_per_image
+            # Small tolerance so float accumulation does not refuse the last image
+            if self.max_cost is not None and self.spent + self.reserved + cost > self.max_cost + 1e-9:
+                self.stop_reason = self.stop_reason or f"job spend limit ${self.max_cost:.2f} reached"
+                return False
+            if self.ledger is not None and self.user_id is not None:
+                if not self.ledger.reserve(self.user_id, cost):
+                    self.stop_reason = self.stop_reason or "daily user spend limit reached"
+                    return False
+            self.reserved += cost
+            return True
+
+    def settle(self, charged: bool):
+        """Release one reservation, charging it if the request was billed"""
+        with self._lock:
+            cost = self.cost_per_image
+            self.reserved = max(0.0, self.reserved - cost)
+            if charged:
+                self.spent += cost
+            if self.ledger is not None and self.user_id is not None:
+                self.ledger.settle(self.user_id, cost, charged)
+
+    def _charge_time(self) -> bool:
+        """Charge time elapsed since the last charge to the user's daily limit"""
+        if self.ledger is None or self.user_id is None:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            seconds, self._charged_at = now - self._charged_at, now
+        return self.ledger.add_time(self.user_id, seconds)
+
+    def check(self) -> Optional[str]:
+        """Return the reason the job must stop now, or None"""
+        # User time is charged as the job runs, so concurrent jobs share the allowance
+        if not self._charge_time():
+            self.stop_reason = self.stop_reason or "daily user time limit reached"
+            return self.stop_reason
+        if self.deadline_seconds is not None and self.elapsed >= self.deadline_seconds:
+            self.stop_reason = self.stop_reason or f"deadline of {self.deadline_seconds:.0f}s reached"
+            return self.stop_reason
+        return None
+
+    def close(self):
+        """Charge the job's remaining wall-clock time against the user's daily limit"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._charge_time()
+
+
+# Process-wide state shared by every session served by this process
+user_ledger = SpendLedger(
+    daily_spend_limit=config.BUDGET_CONFIG['user_daily_spend_limit'],
+    daily_seconds_limit=config.BUDGET_CONFIG['user_daily_seconds_limit']
+)
+
+_jobs_lock = threading.Lock()
+_active_jobs: Dict[str, CancelToken] = {}
+
+
+def register_job(cancel_token: CancelToken) -> str:
+    """Register a running job so it can be cancelled by id"""
+    job_id = uuid.uuid4().hex[:12]
+    with _jobs_lock:
+        _active_jobs[job_id] = cancel_token
+    return job_id
+
+
+def unregister_job(job_id: str):
+    with _jobs_lock:
+        _active_jobs.pop(job_id, None)
+
+
+def cancel_job(job_id: str, reason: str = "cancelled by user") -> bool:
+    """Cancel a running job; returns False if no such job is active"""
+    with _jobs_lock:
+        token = _active_jobs.get(job_id)
+    if token is None:
+        return False
+    token.cancel(reason)
+    return True
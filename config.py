@@ -166,6 +166,7 @@ UI_CONFIG = {
     "page_title": "Bulk Jewelry Image Generator - Flux 2",
     "page_icon": "💎",
     "layout": "wide",
+    "gallery_page_size": 24,  # images rendered per gallery page
     "theme": {
         "primary_color": "#1E40AF",
         "background_color": "#FFFFFF",
@@ -174,18 +175,38 @@ UI_CONFIG = {
     }
 }
 
-# Cost Estimation (per image in USD)
+# fal.ai Flux models offered in the UI
+FLUX_MODELS = [
+    "fal-ai/flux/dev",
+    "fal-ai/flux-pro/v1.1",
+    "fal-ai/flux-2-pro",
+    "fal-ai/flux/schnell"
+]
+DEFAULT_MODEL = "fal-ai/flux/dev"
+
+# Cost Estimation (per 1024x1024 image in USD, scaled by pixel area)
 COST_PER_IMAGE = {
-    "flux-pro": 0.01,
-    "flux-dev": 0.005,
-    "flux-schnell": 0.002
+    "fal-ai/flux/dev": 0.025,
+    "fal-ai/flux-pro/v1.1": 0.04,
+    "fal-ai/flux-2-pro": 0.03,
+    "fal-ai/flux/schnell": 0.01
 }
 
-# Time Estimation (seconds per image)
+# Time Estimation (seconds per 1024x1024 image at 28 steps)
+# Only a prior: replaced by timings fitted from real requests
 TIME_PER_IMAGE = {
-    "flux-pro": 10,
-    "flux-dev": 8,
-    "flux-schnell": 3
+    "fal-ai/flux/dev": 8,
+    "fal-ai/flux-pro/v1.1": 10,
+    "fal-ai/flux-2-pro": 12,
+    "fal-ai/flux/schnell": 3
+}
+
+# Performance model fitted from recorded request timings
+PERFORMANCE_CONFIG = {
+    "timings_path": "data/timings.jsonl",
+    "max_samples": 500,  # per (model, image size)
+    "min_samples": 3,  # before the fit replaces the prior
+    "decay": 0.97  # weight of each older sample relative to the next
 }
 
 # Quality Presets
@@ -193,17 +214,17 @@ QUALITY_PRESETS = {
     "Maximum Quality": {
         "output_quality": 100,
         "prompt_upsampling": True,
-        "model": "flux-pro"
+        "model": "fal-ai/flux-pro/v1.1"
     },
     "Balanced": {
         "output_quality": 95,
         "prompt_upsampling": True,
-        "model": "flux-pro"
+        "model": "fal-ai/flux/dev"
     },
     "Fast Draft": {
         "output_quality": 85,
         "prompt_upsampling": False,
-        "model": "flux-schnell"
+        "model": "fal-ai/flux/schnell"
     }
 }
 
@@ -229,6 +250,58 @@ RATE_LIMIT_CONFIG = {
     "retry_delay": 5  # seconds
 }
 
+# Budgets (None = no limit)
+BUDGET_CONFIG = {
+    "max_cost_per_job": None,  # USD
+    "max_seconds_per_job": None,  # wall-clock deadline
+    "user_daily_spend_limit": 50.0,  # USD per user per day
+    "user_daily_seconds_limit": 4 * 3600,  # generation time per user per day
+    "poll_interval": 0.5  # seconds between budget checks while a job runs
+}
+
+# Worker queue (see work_queue.py and worker.py)
+QUEUE_CONFIG = {
+    "db_path": "data/queue.sqlite3",
+    "output_dir": "data/images",
+    "lease_seconds": 120,  # a task is requeued if its worker stops heartbeating
+    "heartbeat_interval": 20,
+    "poll_interval": 2.0,  # seconds between lease attempts when idle
+    "concurrency": 5,  # requests in flight per worker process
+    "insert_batch_size": 500  # tasks inserted per transaction when submitting a job
+}
+
+# Streaming results for very large jobs
+STREAM_CONFIG = {
+    "results_dir": "data/results",  # one JSON-lines manifest per job
+    "session_preview_limit": 200  # results kept in session state for the gallery
+}
+
+# Per-session image store (see results.py)
+RESULT_STORE_CONFIG = {
+    "sessions_dir": "data/sessions",  # one mmap-backed image file per browser session
+    "session_max_age_seconds": 24 * 3600  # stores untouched this long are swept
+}
+
+# Debug panel
+DEBUG_CONFIG = {
+    "show_profiler": False,  # show the per-section rerun profile by default
+    "rerun_history": 50  # reruns kept for the timing chart
+}
+
+# Local HTTP API (see api_server.py)
+API_CONFIG = {
+    "host": "127.0.0.1",  # local only by default
+    "port": 8765,
+    "data_dir": "data/api",  # per-job images, manifests and ZIPs
+    "max_concurrent_jobs": 4,  # further jobs wait in 'queued'
+    "max_images_per_job": 50000,
+    "max_inference_steps": 50,
+    "max_request_bytes": 1024 * 1024,
+    "sse_keepalive_seconds": 15,
+    "max_retained_jobs": 200,  # finished jobs kept (with their files) before the oldest are removed
+    "job_retention_seconds": 7 * 24 * 3600  # finished jobs older than this are removed
+}
+
 # Advanced Features (Future)
 ADVANCED_FEATURES = {
     "enable_controlnet": False,  # For precise control using reference images
@@ -0,0 +1,281 @@
+"""
+Generation engine for Bulk Jewelry Image Generator
+Prompt expansion and parallel fal.ai requests, independent of the Streamlit UI
+"""
+
+import os
+import base64
+import json
+import logging
+import time
+import concurrent.futures
+from io import BytesIO
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import fal_client
+import requests
+from PIL import Image
+
+import config
+from budget import CancelToken, JobBudget
+from performance import PerformanceModel
+
+logger = logging.getLogger(__name__)
+
+
+def get_image_base64(image_path_or_url):
+    """Convert image to base64 for API"""
+    if image_path_or_url.startswith('http'):
+        response = requests.get(image_path_or_url)
+        img = Image.open(BytesIO(response.content))
+    else:
+        img = Image.open(image_path_or_url)
+
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+    img_str = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:image/png;base64,{img_str}"
+
+def iter_variation_prompts(base_prompt: str, num_variations: int, params: Dict) -> Iterator[Dict]:
+    """Lazily yield varied prompts for jewelry generation, one at a time"""
+
+    materials = params.get('materials', ['gold', 'silver', 'platinum', 'rose gold'])
+    gemstones = params.get('gemstones', ['diamond', 'sapphire', 'emerald', 'ruby'])
+    styles = params.get('styles', ['modern', 'vintage', 'minimalist', 'ornate'])
+    angles = params.get('angles', ['front view', 'side view', '3/4 view', 'top view'])
+    backgrounds = params.get('backgrounds', ['white studio background', 'luxury velvet background',
+                                             'marble surface', 'minimalist gray background'])
+    lighting = params.get('lighting', ['studio lighting', 'natural daylight', 'dramatic lighting',
+                                       'soft diffused light'])
+
+    for i in range(num_variations):
+        material = materials[i % len(materials)]
+        gemstone = gemstones[i % len(gemstones)]
+        style = styles[i % len(styles)]
+        angle = angles[i % len(angles)]
+        background = backgrounds[i % len(backgrounds)]
+        light = lighting[i % len(lighting)]
+
+        variation_prompt = f"{base_prompt}, {material} jewelry, {gemstone} stones, {style} style, {angle}, {background}, {light}, professional product photography, high detail, 8K resolution, commercial photography"
+
+        yield {
+            'prompt': variation_prompt,
+            'metadata': {
+                'material': material,
+                'gemstone': gemstone,
+                'style': style,
+                'angle': angle,
+                'background': background,
+                'lighting': light,
+                'index': i + 1
+            }
+        }
+
+def create_variations_prompts(base_prompt: str, num_variations: int, params: Dict) -> List[Dict]:
+    """Create varied prompts for jewelry generation"""
+    return list(iter_variation_prompts(base_prompt, num_variations, params))
+
+def generate_single_image(prompt_data: Dict, api_token: str, model_params: Dict,
+                          cancel_token: Optional[CancelToken] = None,
+                          client: Optional[fal_client.SyncClient] = None) -> Dict:
+    """Generate a single image using fal.ai Flux
+
+    Pass a ``client`` to reuse one connection pool across a job; otherwise a
+    client is created for ``api_token``. The key is never written to the
+    process environment, so concurrent jobs can use different keys.
+    """
+    try:
+        if cancel_token is not None and cancel_token.is_set():
+            return {
+                'success': False,
+                'cancelled': True,
+                'error': cancel_token.reason,
+                'metadata': prompt_data['metadata']
+            }
+
+        if client is None:
+            client = fal_client.SyncClient(key=api_token)
+
+        # Choose model based on params
+        model_choice = model_params.get('model', 'fal-ai/flux/dev')
+
+        # fal.ai Flux model, submitted through the queue so it can be cancelled
+        submitted = time.monotonic()
+        handle = client.submit(
+            model_choice,
+            arguments={
+                "prompt": prompt_data['prompt'],
+                "image_size": model_params.get('image_size', '1024x1024'),
+                "num_inference_steps": model_params.get('num_inference_steps', 28),
+                "guidance_scale": model_params.get('guidance_scale', 3.5),
+                "num_images": 1,
+                "enable_safety_checker": model_params.get('enable_safety_checker', True),
+                "output_format": model_params.get('output_format', 'png')
+            }
+        )
+
+        if cancel_token is not None:
+            cancel_token.track(handle)
+        try:
+            # Running time and fal queue wait are timed apart: the wait grows
+            # when fal throttles concurrency, the running time does not
+            started = None
+            for status in handle.iter_events():
+                if started is None and isinstance(status, (fal_client.InProgress, fal_client.Completed)):
+                    started = time.monotonic()
+            result = handle.get()
+            if started is None:
+                started = time.monotonic()
+        finally:
+            if cancel_token is not None:
+                cancel_token.untrack(handle)
+
+        # Get image URL from result
+        if isinstance(result, dict) and 'images' in result:
+            image_url = result['images'][0]['url']
+        else:
+            image_url = result
+
+        return {
+            'success': True,
+            'url': image_url,
+            'elapsed': time.monotonic() - started,
+            'queued': started - submitted,
+            'metadata': prompt_data['metadata']
+        }
+    except Exception as e:
+        return {
+            'success': False,
+            'cancelled': cancel_token is not None and cancel_token.is_set(),
+            'error': str(e),
+            'metadata': prompt_data['metadata']
+        }
+
+def generate_images_parallel(prompts: Iterable[Dict], api_token: str, model_params: Dict,
+                             max_workers: int = 5, budget: Optional[JobBudget] = None,
+                             cancel_token: Optional[CancelToken] = None,
+                             perf: Optional[PerformanceModel] = None) -> Iterator[Dict]:
+    """Generate multiple images in parallel, honouring budgets and cancellation
+
+    Prompts are pulled lazily and submitted through a window of
+    ``2 * max_workers``, so memory stays flat however many prompts there are
+    and a budget or cancellation stops new submissions promptly. When the job stops,
+    queued futures and fal requests are cancelled and finished results are
+    still yielded. Successful request timings are recorded into ``perf``.
+    """
+    if cancel_token is None:
+        cancel_token = CancelToken()
+    client = fal_client.SyncClient(key=api_token)
+    poll_interval = config.BUDGET_CONFIG['poll_interval']
+    window = max_workers * 2
+
+    prompt_iter = iter(prompts)
+    pending = {}
+    exhausted = False
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            if budget is not None and not cancel_token.is_set():
+                reason = budget.check()
+                if reason:
+                    cancel_token.cancel(reason)
+
+            if cancel_token.is_set():
+                for future in pending:
+                    future.cancel()
+
+            # Top up the submission window
+            while not exhausted and not cancel_token.is_set() and len(pending) < window:
+                prompt = next(prompt_iter, None)
+                if prompt is None or (budget is not None and not budget.reserve()):
+                    exhausted = True
+                    break
+                future = executor.submit(generate_single_image, prompt, api_token,
+                                         model_params, cancel_token, client)
+                pending[future] = prompt
+
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, timeout=poll_interval,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                if future.cancelled():
+                    if budget is not None:
+                        budget.settle(charged=False)
+                    continue
+                result = future.result()
+                if budget is not None:
+                    budget.settle(charged=result['success'])
+                if perf is not None and result['success']:
+                    try:
+                        perf.record(model_params.get('model', 'fal-ai/flux/dev'),
+                                    model_params.get('image_size', '1024x1024'),
+                                    model_params.get('num_inference_steps', 28),
+                                    result['elapsed'], result['queued'], max_workers)
+                    except Exception:
+                        # Timings are telemetry; a failed write must not abort the job
+                        logger.exception("Could not record request timing")
+                if result.get('cancelled'):
+                    continue
+                yield result
+    finally:
+        if pending:
+            # Abandoned mid-job (e.g. the consumer stopped iterating)
+            cancel_token.cancel(cancel_token.reason or "generation interrupted")
+        executor.shutdown(wait=True, cancel_futures=True)
+        if budget is not None:
+            for future in pending:
+                budget.settle(charged=future.done() and not future.cancelled()
+                              and future.result()['success'])
+            budget.close()
+
+def stream_results_to_disk(results: Iterable[Dict], manifest_path: str) -> Iterator[Dict]:
+    """Append each result to a JSON-lines manifest as it arrives and pass it on"""
+    results = iter(results)
+    os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+    try:
+        with open(manifest_path, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                yield result
+    finally:
+        # Stop (and cancel) the upstream job if the consumer stops early
+        close = getattr(results, 'close', None)
+        if close is not None:
+            close()
+
+def append_results(manifest_path: str, results: Iterable[Dict]):
+    """Append a batch of results to a JSON-lines manifest"""
+    for _ in stream_results_to_disk(results, manifest_path):
+        pass
+
+def iter_results(manifest_path: str, successful_only: bool = True) -> Iterator[Dict]:
+    """Lazily read results back from a JSON-lines manifest"""
+    if not os.path.exists(manifest_path):
+        return
+    with open(manifest_path) as f:
+        for line in f:
+            result = json.loads(line)
+            if result.get('success') or not successful_only:
+                yield result
+
+def download_image(url: str, filepath: str):
+    """Download image from URL"""
+    response = requests.get(url)
+    with open(filepath, 'wb') as f:
+        f.write(response.content)
+
+def post_process_image(filepath: str, thumbnail_size: int = 256) -> Dict:
+    """Verify a downloaded image and write a thumbnail next to it"""
+    with Image.open(filepath) as img:
+        img.verify()
+    root, ext = os.path.splitext(filepath)
+    thumb_path = f"{root}_thumb.jpg"
+    with Image.open(filepath) as img:
+        img.thumbnail((thumbnail_size, thumbnail_size))
+        img.convert('RGB').save(thumb_path, format="JPEG", quality=85)
+    return {'path': filepath, 'thumbnail': thumb_path}
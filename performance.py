@@ -0,0 +1,304 @@
+"""
+Throughput and cost model for Bulk Jewelry Image Generator
+Fitted continuously from recorded per-request timings and used to estimate
+ETA and cost before a job starts, and to pick concurrency (and optionally the
+model) that meets a deadline at minimum cost
+"""
+
+import json
+import math
+import os
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows: timings are appended but never compacted
+    fcntl = None
+
+# Reference point for the priors in config.TIME_PER_IMAGE / COST_PER_IMAGE
+REFERENCE_STEPS = 28
+REFERENCE_PIXELS = 1024 * 1024
+
+
+def megapixel_ratio(image_size: str) -> float:
+    """Pixel area of an image size relative to 1024x1024"""
+    width, height = (int(v) for v in image_size.lower().split('x'))
+    return (width * height) / REFERENCE_PIXELS
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Exclusive advisory lock on the timings file, shared by every process using it"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _weighted_fit(samples: List[Tuple[int, float]], decay: float) -> Tuple[float, float]:
+    """Weighted least squares fit of seconds = a + b * steps
+
+    Newer samples weigh more (``decay ** age``). Falls back to a line through
+    the origin when every sample used the same step count.
+    """
+    n = len(samples)
+    sw = sx = sy = sxx = sxy = 0.0
+    for age, (steps, seconds) in enumerate(reversed(samples)):
+        w = decay ** age
+        sw += w
+        sx += w * steps
+        sy += w * seconds
+        sxx += w * steps * steps
+        sxy += w * steps * seconds
+    denom = sw * sxx - sx * sx
+    if n >= 2 and denom > 1e-9 * sw * sxx:
+        b = (sw * sxy - sx * sy) / denom
+        a = (sy - b * sx) / sw
+        if b > 0 and a >= 0:
+            return a, b
+    # Proportional model through the origin
+    return 0.0, (sxy / sxx) if sxx else 0.0
+
+
+class PerformanceModel:
+    """Per-request latency model keyed by (model, image size), fitted on steps"""
+
+    def __init__(self, path: Optional[str] = None, max_samples: int = 500,
+                 min_samples: int = 3, decay: float = 0.97):
+        self.path = path
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.decay = decay
+        self._lock = threading.Lock()
+        self._samples: Dict[Tuple[str, str], deque] = {}  # (model, size) -> (steps, run seconds)
+        self._waits: Dict[Tuple[str, int], deque] = {}  # (model, concurrency) -> fal queue seconds
+        self._file_rows = 0
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        self._samples, self._waits, self._file_rows = self._read_file()
+        if self._file_rows > self._retained():
+            self._compact()
+
+    def _read_file(self) -> Tuple[Dict[Tuple[str, str], deque], Dict[Tuple[str, int], deque], int]:
+        """Newest samples from the timings file, and its row count
+
+        A row holds a run time (steps, seconds), a queue wait (workers,
+        queued) or both.
+        """
+        samples: Dict[Tuple[str, str], deque] = {}
+        waits: Dict[Tuple[str, int], deque] = {}
+        rows = 0
+        if not os.path.exists(self.path):
+            return samples, waits, rows
+        with open(self.path) as f:
+            for line in f:
+                rows += 1
+                try:
+                    row = json.loads(line)
+                    if 'seconds' in row:
+                        self._add(row['model'], row['image_size'], row['steps'], row['seconds'], samples)
+                    if 'queued' in row:
+                        self._add_wait(row['model'], row['workers'], row['queued'], waits)
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return samples, waits, rows
+
+    def _add(self, model: str, image_size: str, steps: int, seconds: float,
+             samples: Optional[Dict[Tuple[str, str], deque]] = None):
+        samples = self._samples if samples is None else samples
+        key = (model, image_size)
+        if key not in samples:
+            samples[key] = deque(maxlen=self.max_samples)
+        samples[key].append((int(steps), float(seconds)))
+
+    def _add_wait(self, model: str, workers: int, queued: float,
+                  waits: Optional[Dict[Tuple[str, int], deque]] = None):
+        waits = self._waits if waits is None else waits
+        key = (model, int(workers))
+        if key not in waits:
+            waits[key] = deque(maxlen=self.max_samples)
+        waits[key].append(float(queued))
+
+    def _retained(self) -> int:
+        """Rows a compacted timings file holds"""
+        return (sum(len(samples) for samples in self._samples.values())
+                + sum(len(waits) for waits in self._waits.values()))
+
+    def _compact(self):
+        """Rewrite the timings file with only the newest max_samples per key
+
+        The app, the API server and every worker append to the same file, so
+        it is re-read under the file lock and rewritten from what it holds,
+        not from this process's samples, which would drop the others' rows.
+        """
+        if fcntl is None:
+            return
+        with _file_lock(self.path):
+            samples, waits, _ = self._read_file()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.',
+                                            prefix=os.path.basename(self.path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    for (model, image_size), key_samples in samples.items():
+                        for steps, seconds in key_samples:
+                            f.write(json.dumps({'model': model, 'image_size': image_size,
+                                                'steps': steps, 'seconds': round(seconds, 3)}) + '\n')
+                    for (model, workers), key_waits in waits.items():
+                        for queued in key_waits:
+                            f.write(json.dumps({'model': model, 'workers': workers,
+                                                'queued': round(queued, 3)}) + '\n')
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        # Other processes' recent timings come along for free
+        self._samples, self._waits = samples, waits
+        self._file_rows = self._retained()
+
+    def record(self, model: str, image_size: str, steps: int, seconds: float,
+               queued: Optional[float] = None, workers: Optional[int] = None):
+        """Record one successful request: its running time and, if known, how long
+        it waited in fal's queue while ``workers`` requests were submitted at once
+        """
+        row = {'model': model, 'image_size': image_size, 'steps': int(steps), 'seconds': round(seconds, 3)}
+        with self._lock:
+            self._add(model, image_size, steps, seconds)
+            if queued is not None and workers is not None:
+                self._add_wait(model, workers, queued)
+                row.update(workers=int(workers), queued=round(queued, 3))
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                # Under the lock, so an append cannot land in a file being replaced
+                with _file_lock(self.path), open(self.path, 'a') as f:
+                    f.write(json.dumps(row) + '\n')
+                self._file_rows += 1
+                # Keep the file within about twice max_samples per key
+                if self._file_rows >= 2 * self._retained():
+                    self._compact()
+
+    def sample_count(self, model: str, image_size: Optional[str] = None) -> int:
+        with self._lock:
+            return sum(len(v) for (m, s), v in self._samples.items()
+                       if m == model and (image_size is None or s == image_size))
+
+    def latency(self, model: str, image_size: str, steps: int) -> float:
+        """Expected seconds for one request"""
+        scale = megapixel_ratio(image_size)
+        with self._lock:
+            exact = list(self._samples.get((model, image_size), ()))
+            if len(exact) >= self.min_samples:
+                a, b = _weighted_fit(exact, self.decay)
+                return a + b * steps
+
+            # Borrow samples from other sizes of the same model, scaled by pixel area
+            pooled = []
+            for (m, size), samples in self._samples.items():
+                if m == model:
+                    ratio = scale / megapixel_ratio(size)
+                    pooled.extend((n, sec * ratio) for n, sec in samples)
+            if len(pooled) >= self.min_samples:
+                a, b = _weighted_fit(pooled, self.decay)
+                return a + b * steps
+
+        prior = config.TIME_PER_IMAGE.get(model, config.TIME_PER_IMAGE[config.DEFAULT_MODEL])
+        return prior * (steps / REFERENCE_STEPS) * scale
+
+    def cost_per_image(self, model: str, image_size: str) -> float:
+        """Price of one image, billed by pixel area"""
+        price = config.COST_PER_IMAGE.get(model, config.COST_PER_IMAGE[config.DEFAULT_MODEL])
+        return price * max(1.0, megapixel_ratio(image_size))
+
+    def queue_wait(self, model: str, workers: int) -> float:
+        """Expected seconds a request waits in fal's queue at this concurrency
+
+        Grows when fal throttles the account's concurrent requests.
+        Interpolated between the concurrencies with enough samples, and 0
+        when there are none.
+        """
+        with self._lock:
+            known = {w: self._weighted_mean(waits) for (m, w), waits in self._waits.items()
+                     if m == model and len(waits) >= self.min_samples}
+        if not known:
+            return 0.0
+        lower = max((w for w in known if w <= workers), default=None)
+        upper = min((w for w in known if w >= workers), default=None)
+        if lower is None or upper is None or lower == upper:
+            return known[upper if lower is None else lower]
+        fraction = (workers - lower) / (upper - lower)
+        return known[lower] + fraction * (known[upper] - known[lower])
+
+    def _weighted_mean(self, values: Iterable[float]) -> float:
+        values = list(values)
+        weights = [self.decay ** age for age in range(len(values) - 1, -1, -1)]
+        return sum(w * v for w, v in zip(weights, values)) / sum(weights)
+
+    def estimate(self, model: str, image_size: str, steps: int,
+                 num_images: int, workers: int) -> Dict:
+        """ETA and cost for a job before it starts"""
+        latency = self.latency(model, image_size, steps)
+        workers = max(1, min(workers, num_images))
+        queue_wait = self.queue_wait(model, workers)
+        return {
+            'model': model,
+            'workers': workers,
+            'latency': latency,
+            'queue_wait': queue_wait,
+            'eta_seconds': math.ceil(num_images / workers) * (latency + queue_wait),
+            'cost': num_images * self.cost_per_image(model, image_size),
+            'samples': self.sample_count(model, image_size)
+        }
+
+    def plan(self, num_images: int, image_size: str, steps: int,
+             deadline_seconds: Optional[float], models: Iterable[str],
+             max_workers: int) -> Dict:
+        """Cheapest (model, concurrency) that meets the deadline
+
+        Uses the fewest workers that finish in time, to stay clear of rate
+        limits. Queue wait is estimated per concurrency, so adding workers
+        that fal would only queue does not look faster. If nothing meets the
+        deadline, returns the fastest option with ``feasible`` set to False.
+        """
+        options = []
+        for model in models:
+            if deadline_seconds is None:
+                plan = self.estimate(model, image_size, steps, num_images, max_workers)
+                plan['feasible'] = True
+                options.append(plan)
+                continue
+            fastest = None
+            for workers in range(1, max(1, min(max_workers, num_images)) + 1):
+                plan = self.estimate(model, image_size, steps, num_images, workers)
+                plan['feasible'] = plan['eta_seconds'] <= deadline_seconds
+                if plan['feasible']:
+                    break
+                if fastest is None or plan['eta_seconds'] < fastest['eta_seconds']:
+                    fastest = plan
+            options.append(plan if plan['feasible'] else fastest)
+
+        feasible = [p for p in options if p['feasible']]
+        if feasible:
+            return min(feasible, key=lambda p: (p['cost'], p['eta_seconds']))
+        return min(options, key=lambda p: (p['eta_seconds'], p['cost']))
+
+
+# Process-wide model shared by every session served by this process
+performance_model = PerformanceModel(
+    path=config.PERFORMANCE_CONFIG['timings_path'],
+    max_samples=config.PERFORMANCE_CONFIG['max_samples'],
+    min_samples=config.PERFORMANCE_CONFIG['min_samples'],
+    decay=config.PERFORMANCE_CONFIG['decay']
+)
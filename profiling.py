@@ -0,0 +1,38 @@
+"""
+Rerun profiler for Bulk Jewelry Image Generator
+Times named sections of one Streamlit script run so the debug panel can show
+where each rerun spends its time
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+class RerunProfiler:
+    """Wall-clock timings for the sections of a single script run"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sections: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def section(self, name: str):
+        """Time the enclosed block under ``name``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sections.append((name, time.perf_counter() - start))
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self) -> Dict:
+        """Per-section milliseconds plus the total for the run so far"""
+        total = self.total
+        timed = sum(seconds for _, seconds in self.sections)
+        rows = [{'section': name, 'ms': round(seconds * 1000, 2)} for name, seconds in self.sections]
+        rows.append({'section': '(untimed)', 'ms': round(max(0.0, total - timed) * 1000, 2)})
+        return {'total_ms': round(total * 1000, 2), 'sections': rows}
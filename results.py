@@ -0,0 +1,286 @@
+"""
+Compact result storage for Bulk Jewelry Image Generator
+Results are kept column-wise in typed arrays with the categorical metadata
+(materials, gemstones, styles, ...) interned to small integer codes. Image
+bytes live in an on-disk store read back through mmap, not on the heap.
+"""
+
+import mmap
+import os
+import sys
+import threading
+import time
+import weakref
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import config
+
+CATEGORIES = ('material', 'gemstone', 'style', 'angle', 'background', 'lighting')
+
+
+class Vocabulary:
+    """Interns categorical strings to small integer codes"""
+
+    def __init__(self, values: Iterable[str]):
+        self._lock = threading.Lock()
+        self._values: List[str] = []
+        self._codes: Dict[str, int] = {}
+        for value in values:
+            self.encode(value)
+
+    def encode(self, value: str) -> int:
+        """Code for a value, adding it if it is new (e.g. a custom material)"""
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = len(self._values)
+                    self._values.append(sys.intern(value))
+                    self._codes[value] = code
+        return code
+
+    def code(self, value: str) -> Optional[int]:
+        """Code for a known value, without adding it"""
+        return self._codes.get(value)
+
+    def decode(self, code: int) -> str:
+        return self._values[code]
+
+
+# Process-wide vocabularies, seeded from the config catalogs
+VOCABULARIES = {
+    'material': Vocabulary(config.MATERIALS),
+    'gemstone': Vocabulary(config.GEMSTONES),
+    'style': Vocabulary(config.STYLES),
+    'angle': Vocabulary(config.ANGLES),
+    'background': Vocabulary(config.BACKGROUNDS),
+    'lighting': Vocabulary(config.LIGHTING)
+}
+
+
+class ResultRecord:
+    """One generated image; categorical metadata is held as vocabulary codes"""
+
+    __slots__ = ('row', 'index', 'url', 'path', 'elapsed', 'image_ref') + tuple(
+        f'{name}_code' for name in CATEGORIES)
+
+    def __init__(self, index: int, url: str, codes: Dict[str, int], elapsed: float = 0.0,
+                 path: Optional[str] = None, image_ref: Optional[Tuple[int, int]] = None,
+                 row: int = -1):
+        self.row = row
+        self.index = index
+        self.url = url
+        self.path = path
+        self.elapsed = elapsed
+        self.image_ref = image_ref
+        for name in CATEGORIES:
+            setattr(self, f'{name}_code', codes[name])
+
+    @classmethod
+    def from_result(cls, result: Dict) -> 'ResultRecord':
+        """Build a record from a generator result dict"""
+        metadata = result['metadata']
+        return cls(
+            index=metadata['index'],
+            url=result['url'],
+            codes={name: VOCABULARIES[name].encode(metadata[name]) for name in CATEGORIES},
+            elapsed=result.get('elapsed') or 0.0,
+            path=result.get('path')
+        )
+
+    @property
+    def material(self) -> str:
+        return VOCABULARIES['material'].decode(self.material_code)
+
+    @property
+    def gemstone(self) -> str:
+        return VOCABULARIES['gemstone'].decode(self.gemstone_code)
+
+    @property
+    def style(self) -> str:
+        return VOCABULARIES['style'].decode(self.style_code)
+
+    @property
+    def angle(self) -> str:
+        return VOCABULARIES['angle'].decode(self.angle_code)
+
+    @property
+    def background(self) -> str:
+        return VOCABULARIES['background'].decode(self.background_code)
+
+    @property
+    def lighting(self) -> str:
+        return VOCABULARIES['lighting'].decode(self.lighting_code)
+
+    @property
+    def metadata(self) -> Dict:
+        metadata = {name: getattr(self, name) for name in CATEGORIES}
+        metadata['index'] = self.index
+        return metadata
+
+    def to_dict(self) -> Dict:
+        """The generator result dict this record was built from"""
+        result = {'success': True, 'url': self.url, 'elapsed': self.elapsed,
+                  'metadata': self.metadata}
+        if self.path:
+            result['path'] = self.path
+        return result
+
+
+class ResultTable:
+    """Column-oriented, array-backed list of results for one session"""
+
+    def __init__(self):
+        self.indices = array('I')
+        self.elapsed = array('f')
+        self.codes = {name: array('H') for name in CATEGORIES}
+        self.image_offsets = array('q')
+        self.image_lengths = array('I')
+        self.urls: List[str] = []
+        self.paths: Dict[int, str] = {}  # sparse: only worker results have local files
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def append(self, result: Dict) -> int:
+        """Add a successful generator result; returns its row"""
+        record = ResultRecord.from_result(result)
+        row = len(self.urls)
+        self.indices.append(record.index)
+        self.elapsed.append(record.elapsed)
+        for name in CATEGORIES:
+            self.codes[name].append(getattr(record, f'{name}_code'))
+        self.image_offsets.append(-1)
+        self.image_lengths.append(0)
+        self.urls.append(record.url)
+        if record.path:
+            self.paths[row] = record.path
+        return row
+
+    def __getitem__(self, row: int) -> ResultRecord:
+        offset = self.image_offsets[row]
+        return ResultRecord(
+            index=self.indices[row],
+            url=self.urls[row],
+            codes={name: column[row] for name, column in self.codes.items()},
+            elapsed=self.elapsed[row],
+            path=self.paths.get(row),
+            image_ref=(offset, self.image_lengths[row]) if offset >= 0 else None,
+            row=row
+        )
+
+    def __iter__(self) -> Iterator[ResultRecord]:
+        for row in range(len(self)):
+            yield self[row]
+
+    def set_image(self, row: int, image_ref: Tuple[int, int]):
+        self.image_offsets[row], self.image_lengths[row] = image_ref
+
+    def filter_rows(self, **allowed: Iterable[str]) -> List[int]:
+        """Rows whose categories are in the given value lists, e.g. material=['gold']"""
+        wanted = {}
+        for name, values in allowed.items():
+            if values:
+                wanted[name] = {VOCABULARIES[name].code(v) for v in values}
+        return [row for row in range(len(self))
+                if all(self.codes[name][row] in codes for name, codes in wanted.items())]
+
+    def category_counts(self, name: str) -> Dict[str, int]:
+        """Number of results per value of one category"""
+        vocab = VOCABULARIES[name]
+        return {vocab.decode(code): count for code, count in Counter(self.codes[name]).items()}
+
+    def nbytes(self) -> int:
+        """Approximate heap footprint of the table"""
+        size = sum(sys.getsizeof(column) for column in
+                   (self.indices, self.elapsed, self.image_offsets, self.image_lengths))
+        size += sum(sys.getsizeof(column) for column in self.codes.values())
+        size += sys.getsizeof(self.urls) + sum(sys.getsizeof(url) for url in self.urls)
+        size += sys.getsizeof(self.paths) + sum(sys.getsizeof(p) for p in self.paths.values())
+        return size
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def sweep_image_stores(directory: str, max_age_seconds: float) -> int:
+    """Delete session image stores not written to for ``max_age_seconds``"""
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith('.bin') and entry.stat().st_mtime < cutoff:
+            _remove_file(entry.path)
+            removed += 1
+    return removed
+
+
+class ImageStore:
+    """Append-only on-disk image store, read back through mmap
+
+    The file is created on the first ``put`` and deleted when the store is
+    closed or garbage collected with its session.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+
+    def put(self, data: bytes) -> Tuple[int, int]:
+        """Append image bytes; returns the (offset, length) reference"""
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a+b')
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(data)
+            self._file.flush()
+            return offset, len(data)
+
+    def get(self, image_ref: Tuple[int, int]) -> bytes:
+        offset, length = image_ref
+        with self._lock:
+            if self._map is None or self._map.size() < offset + length:
+                # The file grew since it was last mapped
+                if self._map is not None:
+                    self._map.close()
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[offset:offset + length]
+
+    def size(self) -> int:
+        """Bytes held on disk"""
+        with self._lock:
+            if self._file is None:
+                return 0
+            return os.fstat(self._file.fileno()).st_size
+
+    def clear(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.truncate(0)
+
+    def close(self):
+        """Release the mapping and delete the file"""
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        self._finalizer()
@@ -0,0 +1,101 @@
+"""Tests for api_server.py: validation of job submissions"""
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('fal_client')
+
+import config  # noqa: E402
+from api_server import _parse_job_request  # noqa: E402
+
+
+def parse(**body):
+    body.setdefault('base_prompt', "gold ring")
+    body.setdefault('fal_key', "key")
+    return _parse_job_request(body)
+
+
+def test_defaults():
+    request = parse()
+    assert request['num_images'] == config.DEFAULT_SETTINGS['num_images']
+    assert request['model_params']['model'] == config.DEFAULT_MODEL
+    assert request['model_params']['image_size'] == '1024x1024'
+    assert request['variations'] == {}
+    assert request['max_cost'] is None
+
+
+def test_template_replaces_prompt():
+    name, template = next(iter(config.TEMPLATES.items()))
+    assert parse(base_prompt=None, template=name)['base_prompt'] == template['prompt']
+    with pytest.raises(ValueError, match="unknown template"):
+        parse(template="no such template")
+
+
+@pytest.mark.parametrize('body', [[1, 2], "ring", None, 3])
+def test_body_must_be_an_object(body):
+    with pytest.raises(ValueError, match="JSON object"):
+        _parse_job_request(body)
+
+
+@pytest.mark.parametrize('base_prompt', [None, "", ["ring"]])
+def test_prompt_is_required(base_prompt):
+    with pytest.raises(ValueError, match="base_prompt"):
+        parse(base_prompt=base_prompt)
+
+
+def test_num_images_range():
+    with pytest.raises(ValueError, match="num_images"):
+        parse(num_images=0)
+    with pytest.raises(ValueError, match="num_images"):
+        parse(num_images=config.API_CONFIG['max_images_per_job'] + 1)
+
+
+def test_model_params_are_validated_and_normalised():
+    params = parse(model_params={'image_size': '768X1024', 'num_inference_steps': '20',
+                                 'guidance_scale': '4'})['model_params']
+    assert params['image_size'] == '768x1024'
+    assert params['num_inference_steps'] == 20
+    assert params['guidance_scale'] == 4.0
+
+
+@pytest.mark.parametrize('model_params, message', [
+    ({'model': 'fal-ai/other'}, "unknown model"),
+    ({'image_size': 'square_hd'}, "image_size"),
+    ({'image_size': '0x512'}, "image_size"),
+    ({'num_inference_steps': 0}, "num_inference_steps"),
+    ({'num_inference_steps': 51}, "num_inference_steps"),
+    ({'output_format': '../../etc/x'}, "output_format"),
+    ({'output_format': 'gif'}, "output_format"),
+    ([1], "model_params"),
+])
+def test_bad_model_params(model_params, message):
+    with pytest.raises(ValueError, match=message):
+        parse(model_params=model_params)
+
+
+def test_bad_step_count_type():
+    with pytest.raises((ValueError, TypeError)):
+        parse(model_params={'num_inference_steps': 'many'})
+
+
+def test_variations_accept_lists_of_strings():
+    variations = {'materials': ['gold', 'titanium'], 'lighting': ['candle light']}
+    assert parse(variations=variations)['variations'] == variations
+
+
+@pytest.mark.parametrize('variations, message', [
+    ({'materials': []}, "non-empty list"),
+    ({'materials': "gold"}, "non-empty list"),
+    ({'materials': ['gold', 3]}, "non-empty list"),
+    ({'materials': ['']}, "non-empty list"),
+    ({'metals': ['gold']}, "unknown variation"),
+    (['gold'], "must be an object"),
+])
+def test_bad_variations(variations, message):
+    with pytest.raises(ValueError, match=message):
+        parse(variations=variations)
+
+
+def test_max_workers_is_clamped():
+    assert parse(max_workers=1000)['max_workers'] == config.RATE_LIMIT_CONFIG['max_concurrent_requests']
+    assert parse(max_workers=0)['max_workers'] == 1
@@ -0,0 +1,154 @@
+"""Tests for budget.py: spend ledger, job budgets and cancel tokens"""
+
+import types
+
+import pytest
+
+import budget
+from budget import CancelToken, JobBudget, SpendLedger
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class FakeHandle:
+    def __init__(self, fails: bool = False):
+        self.fails = fails
+        self.cancelled = 0
+
+    def cancel(self):
+        self.cancelled += 1
+        if self.fails:
+            raise RuntimeError("request already running")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(budget, 'time', types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_ledger_reserves_up_to_the_daily_limit():
+    ledger = SpendLedger(daily_spend_limit=0.5)
+    assert all(ledger.reserve('u', 0.025) for _ in range(20))
+    assert not ledger.reserve('u', 0.025)
+    assert ledger.spend_remaining('u') == pytest.approx(0.0)
+
+
+def test_ledger_settle_charges_or_releases():
+    ledger = SpendLedger(daily_spend_limit=1.0)
+    ledger.reserve('u', 0.4)
+    ledger.reserve('u', 0.4)
+    ledger.settle('u', 0.4, charged=True)
+    ledger.settle('u', 0.4, charged=False)
+    usage = ledger.usage('u')
+    assert usage['spent'] == pytest.approx(0.4)
+    assert usage['reserved'] == pytest.approx(0.0)
+    assert ledger.spend_remaining('u') == pytest.approx(0.6)
+
+
+def test_ledger_users_are_independent():
+    ledger = SpendLedger(daily_spend_limit=0.1)
+    assert ledger.reserve('a', 0.1)
+    assert not ledger.reserve('a', 0.1)
+    assert ledger.reserve('b', 0.1)
+
+
+def test_job_budget_stops_at_max_cost():
+    job_budget = JobBudget(cost_per_image=0.025, max_cost=0.5)
+    reserved = 0
+    while job_budget.reserve():
+        reserved += 1
+        job_budget.settle(charged=True)
+    assert reserved == 20
+    assert job_budget.spent == pytest.approx(0.5)
+    assert job_budget.stop_reason == "job spend limit $0.50 reached"
+
+
+def test_job_budget_reservations_count_against_user_limit():
+    ledger = SpendLedger(daily_spend_limit=0.1)
+    first = JobBudget(cost_per_image=0.05, user_id='u', ledger=ledger)
+    second = JobBudget(cost_per_image=0.05, user_id='u', ledger=ledger)
+    assert first.reserve()
+    assert second.reserve()
+    assert not second.reserve()
+    assert second.stop_reason == "daily user spend limit reached"
+
+    # Unbilled requests give their reservation back
+    first.settle(charged=False)
+    assert second.reserve()
+
+
+def test_job_budget_deadline(clock):
+    job_budget = JobBudget(cost_per_image=0.01, deadline_seconds=60)
+    clock.now += 59
+    assert job_budget.check() is None
+    clock.now += 1
+    assert job_budget.check() == "deadline of 60s reached"
+
+
+def test_concurrent_jobs_share_the_user_time_limit(clock):
+    ledger = SpendLedger(daily_seconds_limit=80)
+    jobs = [JobBudget(cost_per_image=0.01, user_id='u', ledger=ledger) for _ in range(3)]
+    clock.now += 30
+    assert [job.check() for job in jobs[:2]] == [None, None]
+    # Each job ran 30 seconds, so the third check goes over 80 seconds in total
+    assert jobs[2].check() == "daily user time limit reached"
+    assert ledger.seconds_remaining('u') == 0.0
+
+
+def test_job_budget_close_charges_remaining_time_once(clock):
+    ledger = SpendLedger(daily_seconds_limit=1000)
+    job_budget = JobBudget(cost_per_image=0.01, user_id='u', ledger=ledger)
+    clock.now += 10
+    job_budget.check()
+    clock.now += 5
+    job_budget.close()
+    job_budget.close()
+    assert ledger.usage('u')['seconds'] == pytest.approx(15)
+
+
+def test_cancel_token_cancels_tracked_handles():
+    token = CancelToken()
+    running, finished = FakeHandle(), FakeHandle()
+    token.track(running)
+    token.track(finished)
+    token.untrack(finished)
+    token.cancel("stop")
+    assert token.is_set()
+    assert token.reason == "stop"
+    assert running.cancelled == 1
+    assert finished.cancelled == 0
+
+
+def test_cancel_token_cancels_handles_tracked_after_cancel():
+    token = CancelToken()
+    token.cancel()
+    late = FakeHandle()
+    token.track(late)
+    assert late.cancelled == 1
+
+
+def test_cancel_token_ignores_handles_that_cannot_be_cancelled():
+    token = CancelToken()
+    token.track(FakeHandle(fails=True))
+    token.cancel("first")
+    token.cancel("second")
+    assert token.reason == "first"
+
+
+def test_cancel_job_by_id():
+    token = CancelToken()
+    job_id = budget.register_job(token)
+    try:
+        assert budget.cancel_job(job_id, "from test")
+        assert token.reason == "from test"
+    finally:
+        budget.unregister_job(job_id)
+    assert not budget.cancel_job(job_id)
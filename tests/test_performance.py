@@ -0,0 +1,156 @@
+"""Tests for performance.py: latency fits, queue wait, plans and the timings file"""
+
+import os
+
+import pytest
+
+import config
+from performance import PerformanceModel, _weighted_fit, megapixel_ratio
+
+DEV = 'fal-ai/flux/dev'
+SCHNELL = 'fal-ai/flux/schnell'
+
+
+@pytest.fixture
+def model():
+    return PerformanceModel(min_samples=3)
+
+
+def test_weighted_fit_recovers_a_line():
+    samples = [(steps, 2.0 + 0.25 * steps) for steps in (10, 20, 30, 40)]
+    a, b = _weighted_fit(samples, decay=0.9)
+    assert a == pytest.approx(2.0)
+    assert b == pytest.approx(0.25)
+
+
+def test_weighted_fit_goes_through_origin_for_one_step_count():
+    a, b = _weighted_fit([(28, 7.0), (28, 7.0), (28, 7.0)], decay=0.9)
+    assert a == 0.0
+    assert b == pytest.approx(0.25)
+
+
+def test_weighted_fit_favours_recent_samples():
+    samples = [(28, 14.0)] * 5 + [(28, 7.0)] * 5
+    _, b = _weighted_fit(samples, decay=0.5)
+    assert b * 28 == pytest.approx(7.0, abs=0.5)
+
+
+def test_megapixel_ratio():
+    assert megapixel_ratio('1024x1024') == 1.0
+    assert megapixel_ratio('512X512') == 0.25
+
+
+def test_latency_uses_the_prior_without_samples(model):
+    assert model.latency(DEV, '1024x1024', 28) == config.TIME_PER_IMAGE[DEV]
+    assert model.latency(DEV, '512x512', 14) == pytest.approx(config.TIME_PER_IMAGE[DEV] / 8)
+
+
+def test_latency_fits_samples_for_the_exact_size(model):
+    for steps in (10, 20, 30):
+        model.record(DEV, '1024x1024', steps, 1.0 + 0.5 * steps)
+    assert model.latency(DEV, '1024x1024', 40) == pytest.approx(21.0)
+    assert model.sample_count(DEV, '1024x1024') == 3
+
+
+def test_latency_borrows_other_sizes_scaled_by_area(model):
+    for steps in (10, 20, 30):
+        model.record(DEV, '512x512', steps, 0.1 * steps)
+    assert model.latency(DEV, '1024x1024', 20) == pytest.approx(8.0)
+    # Samples of another model are never borrowed
+    assert model.latency(SCHNELL, '512x512', 28) == pytest.approx(config.TIME_PER_IMAGE[SCHNELL] / 4)
+
+
+def test_cost_scales_with_area_above_one_megapixel(model):
+    assert model.cost_per_image(DEV, '1024x1024') == config.COST_PER_IMAGE[DEV]
+    assert model.cost_per_image(DEV, '2048x1024') == pytest.approx(2 * config.COST_PER_IMAGE[DEV])
+    assert model.cost_per_image(DEV, '512x512') == config.COST_PER_IMAGE[DEV]
+
+
+def test_queue_wait_is_interpolated_between_concurrencies(model):
+    assert model.queue_wait(DEV, 4) == 0.0
+    for _ in range(3):
+        model.record(DEV, '1024x1024', 28, 8.0, queued=1.0, workers=2)
+        model.record(DEV, '1024x1024', 28, 8.0, queued=13.0, workers=8)
+    assert model.queue_wait(DEV, 1) == pytest.approx(1.0)
+    assert model.queue_wait(DEV, 5) == pytest.approx(7.0)
+    assert model.queue_wait(DEV, 10) == pytest.approx(13.0)
+    assert model.queue_wait(SCHNELL, 5) == 0.0
+
+
+def test_estimate(model):
+    estimate = model.estimate(DEV, '1024x1024', 28, num_images=10, workers=4)
+    assert estimate['workers'] == 4
+    assert estimate['eta_seconds'] == 3 * config.TIME_PER_IMAGE[DEV]
+    assert estimate['cost'] == pytest.approx(10 * config.COST_PER_IMAGE[DEV])
+    # Never more workers than images
+    assert model.estimate(DEV, '1024x1024', 28, num_images=2, workers=8)['workers'] == 2
+
+
+def test_plan_picks_the_cheapest_model_that_meets_the_deadline(model):
+    plan = model.plan(20, '1024x1024', 28, deadline_seconds=30, models=[DEV, SCHNELL], max_workers=5)
+    assert plan['model'] == SCHNELL
+    assert plan['feasible']
+
+
+def test_plan_uses_the_fewest_workers_that_meet_the_deadline(model):
+    plan = model.plan(20, '1024x1024', 28, deadline_seconds=39, models=[DEV], max_workers=10)
+    assert plan['workers'] == 5
+    assert plan['eta_seconds'] == 4 * config.TIME_PER_IMAGE[DEV]
+
+
+def test_plan_without_deadline_uses_max_workers(model):
+    plan = model.plan(20, '1024x1024', 28, deadline_seconds=None, models=[DEV], max_workers=4)
+    assert plan['workers'] == 4
+    assert plan['feasible']
+
+
+def test_infeasible_plan_returns_the_fastest_option(model):
+    plan = model.plan(20, '1024x1024', 28, deadline_seconds=1, models=[DEV, SCHNELL], max_workers=5)
+    assert not plan['feasible']
+    assert plan['model'] == SCHNELL
+    assert plan['workers'] == 5
+
+
+def test_plan_does_not_add_workers_that_fal_only_queues(model):
+    for _ in range(3):
+        model.record(DEV, '1024x1024', 28, 8.0, queued=0.0, workers=4)
+        model.record(DEV, '1024x1024', 28, 8.0, queued=24.0, workers=8)
+    plan = model.plan(40, '1024x1024', 28, deadline_seconds=1, models=[DEV], max_workers=8)
+    assert not plan['feasible']
+    assert plan['workers'] == 4
+
+
+def test_timings_are_reloaded_from_the_file(tmp_path):
+    path = str(tmp_path / 'timings.jsonl')
+    first = PerformanceModel(path)
+    first.record(DEV, '1024x1024', 28, 8.0, queued=2.0, workers=4)
+    second = PerformanceModel(path)
+    assert second.sample_count(DEV) == 1
+    assert second._waits == {(DEV, 4): first._waits[(DEV, 4)]}
+
+
+def test_compaction_keeps_other_processes_timings(tmp_path):
+    path = str(tmp_path / 'timings.jsonl')
+    app, worker = PerformanceModel(path, max_samples=3), PerformanceModel(path, max_samples=3)
+    for _ in range(3):
+        worker.record(SCHNELL, '1024x1024', 4, 1.0)
+    # Six rows of its own make the app compact its three newest
+    for steps in range(6):
+        app.record(DEV, '1024x1024', 20 + steps, 8.0)
+
+    with open(path) as f:
+        assert len(f.readlines()) == 6
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+    assert app.sample_count(SCHNELL) == 3
+    assert [steps for steps, _ in app._samples[(DEV, '1024x1024')]] == [23, 24, 25]
+
+    reloaded = PerformanceModel(path, max_samples=3)
+    assert reloaded.sample_count(DEV) == 3
+    assert reloaded.sample_count(SCHNELL) == 3
+
+
+def test_unreadable_rows_are_skipped(tmp_path):
+    path = tmp_path / 'timings.jsonl'
+    path.write_text('not json\n{"model": "fal-ai/flux/dev"}\n'
+                    '{"model": "fal-ai/flux/dev", "image_size": "1024x1024", "steps": 28, "seconds": 8.0}\n')
+    assert PerformanceModel(str(path)).sample_count(DEV) == 1
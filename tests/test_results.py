@@ -0,0 +1,100 @@
+"""Tests for results.py: the array-backed result table and the session image store"""
+
+import os
+
+import pytest
+
+from results import ImageStore, ResultTable, sweep_image_stores
+
+
+def make_result(index: int, material: str = 'gold', gemstone: str = 'diamond', style: str = 'modern') -> dict:
+    return {
+        'success': True,
+        'url': f"https://v3.fal.media/files/{index:06d}.png",
+        'elapsed': 7.5,
+        'metadata': {
+            'index': index,
+            'material': material,
+            'gemstone': gemstone,
+            'style': style,
+            'angle': 'front view',
+            'background': 'marble surface',
+            'lighting': 'studio lighting'
+        }
+    }
+
+
+@pytest.fixture
+def table():
+    table = ResultTable()
+    table.append(make_result(1, 'gold', 'diamond', 'modern'))
+    table.append(make_result(2, 'silver', 'ruby', 'vintage'))
+    table.append(make_result(3, 'gold', 'ruby', 'modern'))
+    return table
+
+
+def test_record_round_trip(table):
+    record = table[1]
+    assert record.row == 1
+    assert record.index == 2
+    assert (record.material, record.gemstone, record.style) == ('silver', 'ruby', 'vintage')
+    assert record.to_dict() == make_result(2, 'silver', 'ruby', 'vintage')
+    assert [r.index for r in table] == [1, 2, 3]
+
+
+def test_filter_rows(table):
+    assert table.filter_rows() == [0, 1, 2]
+    assert table.filter_rows(material=['gold']) == [0, 2]
+    assert table.filter_rows(material=['gold'], gemstone=['ruby']) == [2]
+    assert table.filter_rows(material=['gold', 'silver'], style=[]) == [0, 1, 2]
+    assert table.filter_rows(material=['copper']) == []
+
+
+def test_category_counts(table):
+    assert table.category_counts('material') == {'gold': 2, 'silver': 1}
+    assert table.category_counts('gemstone') == {'diamond': 1, 'ruby': 2}
+
+
+def test_custom_values_are_interned(table):
+    row = table.append(make_result(4, material='meteorite iron'))
+    assert table[row].material == 'meteorite iron'
+    assert table.filter_rows(material=['meteorite iron']) == [row]
+
+
+def test_paths_and_image_refs(table):
+    result = make_result(4)
+    result['path'] = '/tmp/jewelry_00004.png'
+    row = table.append(result)
+    assert table[row].path == result['path']
+    assert table[0].path is None
+    assert table[row].image_ref is None
+    table.set_image(row, (10, 20))
+    assert table[row].image_ref == (10, 20)
+
+
+def test_image_store_is_created_lazily_and_removed_on_close(tmp_path):
+    path = str(tmp_path / 'sessions' / 'session.bin')
+    store = ImageStore(path)
+    assert not os.path.exists(path)
+    assert store.size() == 0
+
+    first = store.put(b'first image')
+    second = store.put(b'second')
+    assert os.path.exists(path)
+    assert store.get(first) == b'first image'
+    assert store.get(second) == b'second'
+    assert store.size() == len(b'first image') + len(b'second')
+
+    store.clear()
+    assert store.size() == 0
+    store.close()
+    assert not os.path.exists(path)
+
+
+def test_sweep_removes_only_old_stores(tmp_path):
+    old, fresh = tmp_path / 'old.bin', tmp_path / 'fresh.bin'
+    old.write_bytes(b'x')
+    fresh.write_bytes(b'x')
+    os.utime(old, (0, 0))
+    assert sweep_image_stores(str(tmp_path), max_age_seconds=3600) == 1
+    assert sorted(os.listdir(tmp_path)) == ['fresh.bin']
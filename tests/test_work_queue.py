@@ -0,0 +1,169 @@
+"""Tests for work_queue.py: leases, heartbeats, retries, cancellation and deadlines"""
+
+import time
+
+import pytest
+
+from work_queue import WorkQueue
+
+
+def make_prompts(count: int):
+    return [{'prompt': f"ring {i}", 'metadata': {'index': i + 1, 'material': 'gold'}}
+            for i in range(count)]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / 'queue.sqlite3'))
+
+
+def test_lease_claims_ready_tasks_in_order(queue):
+    job_id = queue.submit_job(make_prompts(3), {'model': 'fal-ai/flux/dev'})
+    tasks = queue.lease('w1', 2, lease_seconds=60)
+    assert [task['prompt']['metadata']['index'] for task in tasks] == [1, 2]
+    assert all(task['attempts'] == 1 and task['job_id'] == job_id for task in tasks)
+    assert tasks[0]['model_params'] == {'model': 'fal-ai/flux/dev'}
+    assert [task['prompt']['metadata']['index'] for task in queue.lease('w2', 5, 60)] == [3]
+    assert queue.lease('w3', 5, 60) == []
+
+
+def test_submit_inserts_in_batches_workers_can_lease(queue):
+    leased = []
+
+    def prompts():
+        for i, prompt in enumerate(make_prompts(5)):
+            if i == 3:
+                # The first batch is committed while the rest are expanded
+                leased.extend(queue.lease('w1', 5, 60))
+                queue.complete(leased[0]['id'], 'w1', "https://example.com/1.png", None, 1.0)
+                queue.complete(leased[1]['id'], 'w1', "https://example.com/2.png", None, 1.0)
+                # Every inserted task is finished, but the job is not done yet
+                assert queue.job_progress(leased[0]['job_id'])['status'] == 'running'
+            yield prompt
+
+    job_id = queue.submit_job(prompts(), {}, batch_size=2)
+    assert len(leased) == 2
+    progress = queue.job_progress(job_id)
+    assert progress['total'] == 5
+    assert progress['counts']['queued'] == 3
+
+
+def test_submit_stops_when_the_job_is_cancelled(queue):
+    def prompts():
+        for i, prompt in enumerate(make_prompts(6)):
+            if i == 2:
+                queue.cancel_job(queue.lease('w1', 1, 60)[0]['job_id'])
+            yield prompt
+
+    job_id = queue.submit_job(prompts(), {}, batch_size=2)
+    progress = queue.job_progress(job_id)
+    assert progress['status'] == 'cancelled'
+    assert progress['total'] == 2
+
+
+def test_expired_lease_is_reclaimed(queue):
+    queue.submit_job(make_prompts(1), {})
+    first = queue.lease('w1', 1, lease_seconds=-1)
+    second = queue.lease('w2', 1, lease_seconds=60)
+    assert [task['id'] for task in second] == [first[0]['id']]
+    assert second[0]['attempts'] == 2
+    # The original worker lost the lease
+    assert queue.heartbeat('w1', [first[0]['id']], 60) == [first[0]['id']]
+
+
+def test_repeatedly_expired_lease_is_failed(queue):
+    job_id = queue.submit_job(make_prompts(1), {})
+    for _ in range(3):
+        assert queue.lease('w1', 1, lease_seconds=-1, max_attempts=3)
+    assert queue.lease('w1', 1, lease_seconds=60, max_attempts=3) == []
+    progress = queue.job_progress(job_id)
+    assert progress['counts']['failed'] == 1
+    assert progress['finished']
+
+
+def test_heartbeat_extends_lease(queue):
+    queue.submit_job(make_prompts(1), {})
+    task = queue.lease('w1', 1, lease_seconds=60)[0]
+    assert queue.heartbeat('w1', [task['id']], 60, host='host', pid=1) == []
+    assert queue.lease('w2', 1, 60) == []
+    assert [worker['id'] for worker in queue.active_workers()] == ['w1']
+
+
+def test_cancel_job_stops_queued_and_leased_tasks(queue):
+    job_id = queue.submit_job(make_prompts(3), {})
+    task = queue.lease('w1', 1, lease_seconds=60)[0]
+    assert queue.cancel_job(job_id)
+    assert not queue.cancel_job(job_id)
+    assert queue.lease('w2', 5, 60) == []
+    assert queue.heartbeat('w1', [task['id']], 60) == [task['id']]
+
+    queue.release(task['id'], 'w1')
+    progress = queue.job_progress(job_id)
+    assert progress['status'] == 'cancelled'
+    assert progress['counts']['cancelled'] == 3
+
+
+def test_fail_requeues_until_max_attempts(queue):
+    job_id = queue.submit_job(make_prompts(1), {})
+    task = queue.lease('w1', 1, 60)[0]
+    queue.fail(task['id'], 'w1', "rate limited", max_attempts=2, retry_delay=0)
+    task = queue.lease('w1', 1, 60)[0]
+    assert task['attempts'] == 2
+    queue.fail(task['id'], 'w1', "rate limited", max_attempts=2, retry_delay=0)
+    assert queue.lease('w1', 1, 60) == []
+    progress = queue.job_progress(job_id)
+    assert progress['counts']['failed'] == 1
+    assert progress['status'] == 'done'
+
+
+@pytest.mark.parametrize('stop', ['cancel', 'expire'])
+def test_fail_does_not_requeue_a_stopped_job(queue, stop):
+    job_id = queue.submit_job(make_prompts(2), {}, deadline_seconds=None if stop == 'cancel' else 0.5)
+    task = queue.lease('w1', 1, 60)[0]
+    if stop == 'cancel':
+        queue.cancel_job(job_id)
+    else:
+        time.sleep(0.6)
+        queue.job_progress(job_id)
+    queue.fail(task['id'], 'w1', "timeout", max_attempts=3, retry_delay=0)
+    assert queue.lease('w2', 5, 60) == []
+    progress = queue.job_progress(job_id)
+    assert progress['status'] == ('cancelled' if stop == 'cancel' else 'expired')
+    assert progress['counts']['cancelled'] == 2
+    assert progress['counts']['queued'] == 0
+
+
+def test_fail_backs_off_before_retry(queue):
+    queue.submit_job(make_prompts(1), {})
+    task = queue.lease('w1', 1, 60)[0]
+    queue.fail(task['id'], 'w1', "timeout", max_attempts=3, retry_delay=60)
+    assert queue.lease('w1', 1, 60) == []
+
+
+def test_release_does_not_count_the_attempt(queue):
+    queue.submit_job(make_prompts(1), {})
+    task = queue.lease('w1', 1, 60)[0]
+    queue.release(task['id'], 'w1')
+    assert queue.lease('w2', 1, 60)[0]['attempts'] == 1
+
+
+def test_complete_reports_results_and_finishes_job(queue):
+    job_id = queue.submit_job(make_prompts(2), {})
+    for task in queue.lease('w1', 2, 60):
+        queue.complete(task['id'], 'w1', f"https://example.com/{task['id']}.png", None, 4.5)
+    results = queue.job_results(job_id)
+    assert [result['metadata']['index'] for result in results] == [1, 2]
+    assert results[0]['success'] and results[0]['elapsed'] == 4.5
+    assert queue.job_results(job_id, since_task_id=results[0]['task_id']) == results[1:]
+    progress = queue.job_progress(job_id)
+    assert progress['status'] == 'done'
+    assert progress['counts']['done'] == 2
+
+
+def test_job_past_deadline_expires(queue):
+    job_id = queue.submit_job(make_prompts(2), {}, deadline_seconds=-1)
+    assert queue.lease('w1', 5, 60) == []
+    progress = queue.job_progress(job_id)
+    assert progress['status'] == 'expired'
+    assert progress['counts']['cancelled'] == 2
+    assert progress['finished']
@@ -0,0 +1,315 @@
+"""
+Durable work queue for Bulk Jewelry Image Generator
+A SQLite-backed job/task queue shared by the Streamlit app (producer) and any
+number of worker processes (see worker.py). Tasks are leased with an expiry,
+kept alive by heartbeats, and requeued when a worker fails or disappears.
+"""
+
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from itertools import islice
+from typing import Dict, Iterable, List, Optional
+
+import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    status TEXT NOT NULL,
+    model_params TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    deadline REAL,
+    submitted INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs(id),
+    idx INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    available_at REAL NOT NULL DEFAULT 0,
+    url TEXT,
+    path TEXT,
+    error TEXT,
+    elapsed REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_ready ON tasks(status, available_at);
+CREATE INDEX IF NOT EXISTS tasks_job ON tasks(job_id, status);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    host TEXT,
+    pid INTEGER,
+    heartbeat REAL,
+    active INTEGER
+);
+"""
+
+# Task states
+QUEUED, LEASED, DONE, FAILED, CANCELLED = 'queued', 'leased', 'done', 'failed', 'cancelled'
+TERMINAL = (DONE, FAILED, CANCELLED)
+
+
+class WorkQueue:
+    """Jobs and leased tasks stored in a SQLite database
+
+    Every call opens its own connection, so one instance can be shared by
+    threads. The database uses SQLite's rollback journal rather than WAL,
+    because WAL needs shared memory and so only works for processes on one
+    host. Workers on other machines can share the database only over a
+    network filesystem with working POSIX locks. Writers take the lock up
+    front with BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or config.QUEUE_CONFIG['db_path']
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            # Also switches back databases created in WAL mode
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'deadline' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN deadline REAL")
+            if 'submitted' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN submitted INTEGER NOT NULL DEFAULT 1")
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _connect(self, immediate: bool = False):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    # Producer side
+
+    def submit_job(self, prompts: Iterable[Dict], model_params: Dict,
+                   deadline_seconds: Optional[float] = None,
+                   batch_size: Optional[int] = None) -> str:
+        """Enqueue one task per prompt dict and return the job id
+
+        Tasks are inserted ``batch_size`` at a time, each batch in its own
+        transaction, so workers can lease the first tasks (and other writers
+        get the lock) while the rest of the prompts are still expanded.
+        Submission stops early if the job is cancelled or expires meanwhile.
+
+        Once ``deadline_seconds`` have passed the job expires: queued tasks
+        are cancelled and workers drop leased ones at their next heartbeat.
+        """
+        batch_size = batch_size or config.QUEUE_CONFIG['insert_batch_size']
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, created, status, model_params, deadline, submitted) "
+                "VALUES (?, ?, 'running', ?, ?, 0)",
+                (job_id, now, json.dumps(model_params),
+                 now + deadline_seconds if deadline_seconds is not None else None)
+            )
+        prompts = iter(prompts)
+        try:
+            while True:
+                # Expand the next batch before taking the write lock
+                batch = [(job_id, p['metadata']['index'], p['prompt'], json.dumps(p['metadata']))
+                         for p in islice(prompts, batch_size)]
+                if not batch:
+                    break
+                with self._connect(immediate=True) as conn:
+                    job = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                    if job['status'] != 'running':
+                        break
+                    conn.executemany("INSERT INTO tasks (job_id, idx, prompt, metadata) VALUES (?, ?, ?, ?)",
+                                     batch)
+                    conn.execute("UPDATE jobs SET total = total + ? WHERE id = ?", (len(batch), job_id))
+        finally:
+            # Also on errors, so the job can finish with the tasks it has
+            with self._connect(immediate=True) as conn:
+                conn.execute("UPDATE jobs SET submitted = 1 WHERE id = ?", (job_id,))
+        return job_id
+
+    def cancel_job(self, job_id: str) -> bool:
+        """Cancel queued tasks; workers drop leased ones at their next heartbeat"""
+        with self._connect(immediate=True) as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status = 'running'", (job_id,)
+            ).rowcount
+            conn.execute(
+                "UPDATE tasks SET status = ? WHERE job_id = ? AND status = ?",
+                (CANCELLED, job_id, QUEUED)
+            )
+        return bool(updated)
+
+    def _expire_jobs(self, conn: sqlite3.Connection, now: float):
+        """Expire running jobs past their deadline and cancel their queued tasks"""
+        expired = [row['id'] for row in conn.execute(
+            "SELECT id FROM jobs WHERE status = 'running' AND deadline < ?", (now,)
+        )]
+        for job_id in expired:
+            conn.execute("UPDATE jobs SET status = 'expired' WHERE id = ?", (job_id,))
+            conn.execute("UPDATE tasks SET status = ? WHERE job_id = ? AND status = ?",
+                         (CANCELLED, job_id, QUEUED))
+
+    def job_progress(self, job_id: str) -> Optional[Dict]:
+        """Task counts by state; marks the job done once every task is terminal"""
+        with self._connect(immediate=True) as conn:
+            self._expire_jobs(conn, time.time())
+            job = conn.execute("SELECT status, total, submitted FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = {state: 0 for state in (QUEUED, LEASED) + TERMINAL}
+            for row in conn.execute(
+                "SELECT status, COUNT(*) AS n FROM tasks WHERE job_id = ? GROUP BY status", (job_id,)
+            ):
+                counts[row['status']] = row['n']
+            status = job['status']
+            # Not done while tasks are still being submitted
+            if status == 'running' and job['submitted'] and counts[QUEUED] == 0 and counts[LEASED] == 0:
+                status = 'done'
+                conn.execute("UPDATE jobs SET status = ? WHERE id = ?", (status, job_id))
+        return {'status': status, 'total': job['total'], 'counts': counts,
+                'finished': status != 'running'}
+
+    def job_results(self, job_id: str, since_task_id: int = 0) -> List[Dict]:
+        """Finished results in the same shape as generator.generate_single_image"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, url, path, elapsed, metadata FROM tasks "
+                "WHERE job_id = ? AND status = ? AND id > ? ORDER BY id",
+                (job_id, DONE, since_task_id)
+            ).fetchall()
+        return [{
+            'success': True,
+            'task_id': row['id'],
+            'url': row['url'],
+            'path': row['path'],
+            'elapsed': row['elapsed'],
+            'metadata': json.loads(row['metadata'])
+        } for row in rows]
+
+    # Worker side
+
+    def lease(self, worker_id: str, limit: int, lease_seconds: float,
+              max_attempts: Optional[int] = None) -> List[Dict]:
+        """Claim up to ``limit`` ready tasks, expiring jobs past their deadline
+        and reclaiming expired leases first
+
+        An expired lease counts as a failed attempt, so a task that keeps
+        killing its worker is marked failed after ``max_attempts``.
+        """
+        if max_attempts is None:
+            max_attempts = config.RATE_LIMIT_CONFIG['retry_attempts']
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            self._expire_jobs(conn, now)
+            conn.execute(
+                "UPDATE tasks SET status = CASE "
+                "WHEN (SELECT status FROM jobs WHERE id = tasks.job_id) != 'running' THEN ? "
+                "WHEN attempts >= ? THEN ? ELSE ? END, "
+                "error = CASE WHEN attempts >= ? THEN 'lease expired' ELSE error END, "
+                "worker = NULL WHERE status = ? AND lease_expires < ?",
+                (CANCELLED, max_attempts, FAILED, QUEUED, max_attempts, LEASED, now)
+            )
+            rows = conn.execute(
+                "SELECT t.id, t.job_id, t.prompt, t.metadata, t.attempts, j.model_params "
+                "FROM tasks t JOIN jobs j ON j.id = t.job_id "
+                "WHERE t.status = ? AND t.available_at <= ? AND j.status = 'running' "
+                "ORDER BY t.id LIMIT ?",
+                (QUEUED, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                ((LEASED, worker_id, now + lease_seconds, row['id']) for row in rows)
+            )
+        return [{
+            'id': row['id'],
+            'job_id': row['job_id'],
+            'attempts': row['attempts'] + 1,
+            'prompt': {'prompt': row['prompt'], 'metadata': json.loads(row['metadata'])},
+            'model_params': json.loads(row['model_params'])
+        } for row in rows]
+
+    def heartbeat(self, worker_id: str, task_ids: List[int], lease_seconds: float,
+                  host: str = '', pid: int = 0) -> List[int]:
+        """Extend leases; returns the ids whose job was cancelled or lease was lost"""
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO workers (id, host, pid, heartbeat, active) VALUES (?, ?, ?, ?, ?)",
+                (worker_id, host, pid, now, len(task_ids))
+            )
+            lost = []
+            for task_id in task_ids:
+                extended = conn.execute(
+                    "UPDATE tasks SET lease_expires = ? WHERE id = ? AND worker = ? AND status = ? "
+                    "AND job_id IN (SELECT id FROM jobs WHERE status = 'running')",
+                    (now + lease_seconds, task_id, worker_id, LEASED)
+                ).rowcount
+                if not extended:
+                    lost.append(task_id)
+        return lost
+
+    def complete(self, task_id: int, worker_id: str, url: str, path: Optional[str], elapsed: float,
+                 error: Optional[str] = None):
+        """Mark a task done; ``error`` notes a problem that did not lose the image"""
+        with self._connect(immediate=True) as conn:
+            conn.execute(
+                "UPDATE tasks SET status = ?, url = ?, path = ?, elapsed = ?, error = ? "
+                "WHERE id = ? AND worker = ?",
+                (DONE, url, path, elapsed, error, task_id, worker_id)
+            )
+
+    def fail(self, task_id: int, worker_id: str, error: str,
+             max_attempts: int, retry_delay: float):
+        """Requeue with linear backoff, or mark failed after ``max_attempts``
+
+        Tasks of a cancelled or expired job are cancelled instead of requeued.
+        """
+        with self._connect(immediate=True) as conn:
+            row = conn.execute("SELECT attempts FROM tasks WHERE id = ? AND worker = ?",
+                               (task_id, worker_id)).fetchone()
+            if row is None:
+                return
+            if row['attempts'] >= max_attempts:
+                conn.execute("UPDATE tasks SET status = ?, error = ?, worker = NULL WHERE id = ?",
+                             (FAILED, error, task_id))
+            else:
+                conn.execute(
+                    "UPDATE tasks SET status = CASE WHEN (SELECT status FROM jobs WHERE id = tasks.job_id) = 'running' "
+                    "THEN ? ELSE ? END, error = ?, worker = NULL, available_at = ? WHERE id = ?",
+                    (QUEUED, CANCELLED, error, time.time() + retry_delay * row['attempts'], task_id)
+                )
+
+    def release(self, task_id: int, worker_id: str):
+        """Give a leased task back without counting the attempt"""
+        with self._connect(immediate=True) as conn:
+            conn.execute(
+                "UPDATE tasks SET status = CASE WHEN (SELECT status FROM jobs WHERE id = tasks.job_id) = 'running' "
+                "THEN ? ELSE ? END, worker = NULL, attempts = MAX(attempts - 1, 0) "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (QUEUED, CANCELLED, task_id, worker_id, LEASED)
+            )
+
+    def active_workers(self, within_seconds: float = 60) -> List[Dict]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM workers WHERE heartbeat >= ?",
+                                (time.time() - within_seconds,)).fetchall()
+        return [dict(row) for row in rows]
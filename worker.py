@@ -0,0 +1,176 @@
+"""
+Queue worker for Bulk Jewelry Image Generator
+Leases tasks from the work queue, generates, downloads and post-processes
+images. Run as many of these as you like on this machine, or on other
+machines that reach the queue database over a filesystem with working locks:
+
+    FAL_KEY=... python worker.py --db data/queue.sqlite3 --output data/images
+"""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+import uuid
+import concurrent.futures
+from typing import Dict, Optional
+
+import fal_client
+
+import config
+from budget import CancelToken
+from generator import download_image, generate_single_image, post_process_image
+from performance import performance_model
+from work_queue import WorkQueue
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    """Pulls leased tasks from a WorkQueue and processes them in a thread pool"""
+
+    def __init__(self, queue: WorkQueue, api_token: str, output_dir: str,
+                 concurrency: int = 5, lease_seconds: float = 120,
+                 heartbeat_interval: float = 20, poll_interval: float = 2.0):
+        self.queue = queue
+        self.api_token = api_token
+        self.client = fal_client.SyncClient(key=api_token)
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._tokens: Dict[int, CancelToken] = {}
+
+    def stop(self, *_):
+        self._stop.set()
+
+    def run(self, exit_when_idle: bool = False):
+        """Lease and process tasks until stopped"""
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self._stop.is_set():
+                free = self.concurrency - len(pending)
+                tasks = self.queue.lease(self.worker_id, free, self.lease_seconds) if free else []
+                for task in tasks:
+                    with self._lock:
+                        self._tokens[task['id']] = CancelToken()
+                    pending.add(executor.submit(self._process, task))
+
+                if not pending:
+                    if exit_when_idle:
+                        break
+                    self._stop.wait(self.poll_interval)
+                    continue
+
+                _, pending = concurrent.futures.wait(
+                    pending, timeout=self.poll_interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+
+            # Graceful shutdown: cancel what is still queued at fal and hand it back
+            with self._lock:
+                tokens = list(self._tokens.values())
+            for token in tokens:
+                token.cancel("worker shutting down")
+        self._stop.set()
+
+    def _heartbeat_loop(self):
+        host, pid = socket.gethostname(), os.getpid()
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                task_ids = list(self._tokens)
+            for task_id in self.queue.heartbeat(self.worker_id, task_ids, self.lease_seconds, host, pid):
+                # Job cancelled or lease lost to another worker
+                with self._lock:
+                    token = self._tokens.get(task_id)
+                if token is not None:
+                    token.cancel("job cancelled")
+
+    def _process(self, task: Dict):
+        task_id = task['id']
+        with self._lock:
+            token = self._tokens[task_id]
+        try:
+            result = generate_single_image(task['prompt'], self.api_token, task['model_params'], token,
+                                           self.client)
+            if result['success']:
+                # Generated and billed: never requeue it, even if storing it fails
+                path, error = None, None
+                try:
+                    path = self._store(task, result['url'])
+                except Exception as e:
+                    error = f"post-processing failed: {e}"
+                    logger.warning("Task %s: %s; keeping the fal URL only", task_id, error)
+                self.queue.complete(task_id, self.worker_id, result['url'], path, result['elapsed'], error)
+                self._record_timing(task, result)
+            elif result.get('cancelled'):
+                self.queue.release(task_id, self.worker_id)
+            else:
+                self._fail(task_id, result['error'])
+        except Exception as e:
+            self._fail(task_id, f"worker error: {e}")
+        finally:
+            with self._lock:
+                self._tokens.pop(task_id, None)
+
+    def _record_timing(self, task: Dict, result: Dict):
+        model_params = task['model_params']
+        try:
+            performance_model.record(model_params.get('model', config.DEFAULT_MODEL),
+                                     model_params.get('image_size', '1024x1024'),
+                                     model_params.get('num_inference_steps', 28),
+                                     result['elapsed'], result['queued'], self.concurrency)
+        except Exception:
+            # Timings are telemetry; a failed write must not fail the task
+            logger.exception("Could not record request timing")
+
+    def _store(self, task: Dict, url: str) -> str:
+        job_dir = os.path.join(self.output_dir, task['job_id'])
+        os.makedirs(job_dir, exist_ok=True)
+        fmt = task['model_params'].get('output_format', 'png')
+        filepath = os.path.join(job_dir, f"jewelry_{task['prompt']['metadata']['index']:05d}.{fmt}")
+        download_image(url, filepath)
+        post_process_image(filepath)
+        return filepath
+
+    def _fail(self, task_id: int, error: str):
+        self.queue.fail(task_id, self.worker_id, error,
+                        max_attempts=config.RATE_LIMIT_CONFIG['retry_attempts'],
+                        retry_delay=config.RATE_LIMIT_CONFIG['retry_delay'])
+
+
+def main(argv: Optional[list] = None):
+    queue_config = config.QUEUE_CONFIG
+    parser = argparse.ArgumentParser(description="Jewelry image generation queue worker")
+    parser.add_argument("--db", default=queue_config['db_path'], help="Path to the queue database")
+    parser.add_argument("--output", default=queue_config['output_dir'], help="Directory for finished images")
+    parser.add_argument("--concurrency", type=int, default=queue_config['concurrency'])
+    parser.add_argument("--lease-seconds", type=float, default=queue_config['lease_seconds'])
+    parser.add_argument("--exit-when-idle", action="store_true", help="Stop once the queue is empty")
+    args = parser.parse_args(argv)
+
+    api_token = os.environ.get("FAL_KEY")
+    if not api_token:
+        parser.error("FAL_KEY environment variable is not set")
+
+    worker = Worker(WorkQueue(args.db), api_token, args.output,
+                    concurrency=args.concurrency,
+                    lease_seconds=args.lease_seconds,
+                    heartbeat_interval=min(queue_config['heartbeat_interval'], args.lease_seconds / 3),
+                    poll_interval=queue_config['poll_interval'])
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    print(f"Worker {worker.worker_id} polling {args.db}")
+    worker.run(exit_when_idle=args.exit_when_idle)
+
+
+if __name__ == "__main__":
+    main()